@@ -1,14 +1,14 @@
-from authlib.jose import JsonWebKey
-from django.conf import settings
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from common.apps.refresh_tokens.jwts import token_backend
+
 
 class JWKView(APIView):
     def get(self, _):
-        public_key = JsonWebKey.import_key(
-            settings.JWT_PUBLIC_KEY, {"kty": "RSA", "kid": "default"}
+        # Every kid of the token backend, so the tokens signed after a key
+        # rotation can be verified by the services using JWK_URL
+        return Response(
+            {"keys": token_backend.get_public_jwks()}, status=status.HTTP_200_OK
         )
-
-        return Response({"keys": [public_key]}, status=status.HTTP_200_OK)
@@ -0,0 +1,88 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django_tenants.utils import (
+    get_public_schema_name,
+    get_tenant_model,
+    tenant_context,
+)
+
+from common.models.synchronous_metadata import get_synchronous_metadata
+from common.models.synchronous_model import SynchronousTenantModel, is_synchronous_model
+
+
+class Command(BaseCommand):
+    help = "Send a full snapshot of the synchronous models to their consumers"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "models",
+            nargs="*",
+            type=str,
+            help="Models as app_label.ModelName, all synchronous models by default",
+        )
+        parser.add_argument(
+            "--organization", type=str, help="Organization slug, all by default"
+        )
+        parser.add_argument(
+            "--batch_size", type=int, default=None, help="Rows per snapshot message"
+        )
+
+    def get_models(self, labels):
+        if not labels:
+            return [
+                model
+                for model in apps.get_models()
+                if issubclass(model, SynchronousTenantModel)
+                and is_synchronous_model(model)
+            ]
+
+        models = []
+        for label in labels:
+            try:
+                model = apps.get_model(label)
+            except (LookupError, ValueError) as e:
+                raise CommandError(e)
+            if not (
+                issubclass(model, SynchronousTenantModel)
+                and is_synchronous_model(model)
+            ):
+                raise CommandError(f"{label} is not in SYNCHRONOUS_MODEL")
+            models.append(model)
+        return models
+
+    def handle(self, *args, **kwargs):
+        models = self.get_models(kwargs["models"])
+        for model in models:
+            if get_synchronous_metadata(model).version_field is None:
+                self.stdout.write(
+                    self.style.WARNING(
+                        f"{model._meta.label} has no version field, the consumers "
+                        f"will not delete the rows missing from its snapshot"
+                    )
+                )
+        organizations = get_tenant_model().objects.exclude(
+            schema_name=get_public_schema_name()
+        )
+        if kwargs.get("organization"):
+            organizations = organizations.filter(schema_name=kwargs["organization"])
+
+        for organization in organizations:
+            with tenant_context(organization):
+                for model in models:
+                    total = 0
+                    snapshot = model._default_manager.all().send_synchronous_snapshot(
+                        kwargs["batch_size"]
+                    )
+                    for sent in snapshot:
+                        total += sent
+                        self.stdout.write(
+                            f"{organization.schema_name}: sent {total} "
+                            f"{model._meta.verbose_name_plural}"
+                        )
+
+                    self.stdout.write(
+                        self.style.SUCCESS(
+                            f"{organization.schema_name}: {model._meta.label} "
+                            f"snapshot of {total} rows sent"
+                        )
+                    )
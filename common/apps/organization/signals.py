@@ -0,0 +1,19 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from common.apps.organization.models import Domain, Organization
+from common.middlewares.tenant_middleware import hostname_tenant_cache
+from common.utils.switch_tenant import schema_tenant_cache
+
+
+@receiver(post_save, sender=Domain)
+@receiver(post_delete, sender=Domain)
+@receiver(post_save, sender=Organization)
+@receiver(post_delete, sender=Organization)
+def invalidate_tenant_caches(sender, **kwargs):
+    """
+    Organizations and domains change rarely, drop every cached tenant
+    instead of tracking which hostnames point to the changed row
+    """
+    hostname_tenant_cache.clear()
+    schema_tenant_cache.clear()
@@ -5,7 +5,7 @@ from django.db import transaction
 from django.utils.module_loading import import_string
 
 from common.apps.organization.models import Domain, Organization
-from common.celery.tasks import task
+from common.celery.tasks import task, task_tenant_cache
 
 logger = logging.getLogger(__name__)
 
@@ -34,6 +34,8 @@ def create_organization(id, name, slug_name, is_active, owner, created_at, updat
         updated_at=updated_at,
     )
     organization.save()
+    # A previous organization with the same slug name may still be cached
+    task_tenant_cache.delete(slug_name)
     Domain(
         domain=f"{slug_name}.{settings.DEFAULT_TENANT_HOST}",
         tenant=organization,
@@ -52,3 +54,4 @@ def delete_organization(slug_name):
     logger.info(f"delete_organization({slug_name})")
     organization = Organization.objects.get(schema_name=slug_name)
     organization.delete(force_drop=True)
+    task_tenant_cache.delete(slug_name)
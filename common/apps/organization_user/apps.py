@@ -1,6 +1,13 @@
 from django.apps import AppConfig
 
+from common.models.synchronous_metadata import register_synchronous_models
+
 
 class OrganizationRoleConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "common.apps.organization_user"
+
+    def ready(self):
+        from common.apps.organization_user import signals  # noqa: F401
+
+        register_synchronous_models(self)
@@ -6,11 +6,11 @@ from django.contrib.postgres.fields import ArrayField
 from django.db import models
 from django.utils.translation import gettext_lazy as _
 
-from common.models.synchronous_model import SynchronousTenantModel
+from common.models.synchronous_model import SynchronousQuerySet, SynchronousTenantModel
 from common.utils.social_provider import SocialProvider
 
 
-class UserManager(BaseUserManager):
+class UserManager(BaseUserManager.from_queryset(SynchronousQuerySet)):
     """Define a model manager for User model with no username field."""
 
     use_in_migrations = True
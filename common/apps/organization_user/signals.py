@@ -0,0 +1,18 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework_simplejwt.settings import api_settings
+
+from common.apps.organization_user.models import OrganizationUser
+from common.authentication.user_cache import user_cache
+
+
+@receiver(post_save, sender=OrganizationUser)
+@receiver(post_delete, sender=OrganizationUser)
+def invalidate_user_cache(sender, instance, using=None, **kwargs):
+    """
+    Also covers the replicated updates, the update tasks save the user
+    inside the tenant context
+    """
+    user_cache.delete_on_commit(
+        [getattr(instance, api_settings.USER_ID_FIELD)], using=using
+    )
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from common.apps.outbox.services import relay_outbox_messages
+
+
+class Command(BaseCommand):
+    help = "Publish the pending outbox messages"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch_size", type=int, default=100, help="Messages per batch"
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            help="Keep relaying, polling every given seconds",
+        )
+
+    def handle(self, *args, **kwargs):
+        while True:
+            published = relay_outbox_messages(batch_size=kwargs["batch_size"])
+            if published:
+                self.stdout.write(f"Published {published} messages")
+
+            if kwargs.get("interval") is None:
+                break
+            time.sleep(kwargs["interval"])
@@ -0,0 +1,17 @@
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models
+
+
+class OutboxMessage(models.Model):
+    """
+    A Celery message waiting to be published by the outbox relay.
+
+    Install the app in SHARED_APPS only: the table then lives in the public
+    schema, which is on the search path of every tenant, so messages are
+    written in the transaction of the tenant change and relayed from one
+    place. The auto-increment id keeps the publishing order.
+    """
+
+    name = models.CharField(max_length=256)
+    message = models.JSONField(encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from common.apps.outbox.models import OutboxMessage
+from common.celery.serialization import get_synchronous_message_options
+from common.celery.task_senders import send_task
+
+
+def relay_outbox_messages(batch_size=100):
+    """
+    Publish the pending outbox messages in order, `batch_size` at a time,
+    through one producer per batch. A batch is deleted only once it is
+    published, a failure leaves it to the next run (at-least-once delivery).
+    Returns the number of published messages.
+    """
+    celery_app = import_string(settings.CELERY_APP)
+    total = 0
+    while True:
+        with transaction.atomic():
+            # Blocking lock instead of skip_locked: concurrent relays wait for
+            # each other rather than publishing out of order
+            messages = list(
+                OutboxMessage.objects.select_for_update().order_by("id")[:batch_size]
+            )
+            if not messages:
+                return total
+
+            with celery_app.producer_or_acquire() as producer:
+                for outbox_message in messages:
+                    send_task(
+                        name=outbox_message.name,
+                        message=outbox_message.message,
+                        routing_key=outbox_message.message.get(
+                            "organization_slug_name"
+                        ),
+                        producer=producer,
+                        **get_synchronous_message_options(),
+                    )
+
+            OutboxMessage.objects.filter(
+                id__in=[outbox_message.id for outbox_message in messages]
+            ).delete()
+
+        total += len(messages)
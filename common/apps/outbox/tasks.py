@@ -0,0 +1,15 @@
+import logging
+
+from common.apps.outbox.services import relay_outbox_messages
+from common.celery.tasks import task
+
+logger = logging.getLogger(__name__)
+
+
+@task(name="spacedf.tasks.relay_outbox", max_retries=3)
+def relay_outbox(batch_size=100):
+    """
+    Use in the Celery beat schedule when the relay_outbox command is not run
+    """
+    published = relay_outbox_messages(batch_size=batch_size)
+    logger.info(f"relay_outbox: published {published} messages")
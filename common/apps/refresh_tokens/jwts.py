@@ -1,14 +1,91 @@
+import hashlib
+import time
+
 import jwt
+from django.conf import settings
 from django.db import connection
 from rest_framework.exceptions import AuthenticationFailed
 from rest_framework_simplejwt.backends import TokenBackend
 from rest_framework_simplejwt.settings import api_settings
 from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
 
+from common.utils.cache import LRUCache
 from common.utils.subdomain import extract_subdomain
 
+# (organization slug name, token digest) -> verified payload, kept until the
+# token expires. Disabled unless ACCESS_TOKEN_CACHE_MAX_SIZE is set.
+verified_token_cache = LRUCache(
+    max_size=getattr(settings, "ACCESS_TOKEN_CACHE_MAX_SIZE", 0),
+    ttl=getattr(settings, "ACCESS_TOKEN_CACHE_TTL", 300),
+)
+
 
 class CustomTokenBackend(TokenBackend):
+    """
+    Token backend keeping the parsed key objects of every `kid`, so PyJWT does
+    not parse the PEM keys again on each token.
+
+    New tokens are signed with the key of `signing_kid`. Keys can be rotated
+    at runtime with `add_key`, tokens are verified with the key of the `kid`
+    in their header.
+    """
+
+    def __init__(self, *args, signing_kid="default", verifying_keys=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.signing_kid = signing_kid
+        self.signing_keys = {}
+        self.verifying_keys = {}
+        self.add_key(signing_kid, self.signing_key, self.verifying_key)
+        for kid, verifying_key in (verifying_keys or {}).items():
+            self.add_key(kid, verifying_key=verifying_key)
+
+    def prepare_key(self, key):
+        if not key:
+            return key
+        return jwt.PyJWS().get_algorithm_by_name(self.algorithm).prepare_key(key)
+
+    def add_key(self, kid, signing_key=None, verifying_key=None, activate=False):
+        """
+        Register the keys of a `kid`, set `activate` to sign new tokens with it
+        """
+        if self.algorithm.startswith("HS") and signing_key:
+            verifying_key = signing_key
+        if signing_key:
+            self.signing_keys[kid] = self.prepare_key(signing_key)
+        if verifying_key:
+            self.verifying_keys[kid] = self.prepare_key(verifying_key)
+        if activate:
+            self.signing_kid = kid
+
+    def get_public_jwks(self):
+        """
+        The public keys of every `kid` as JWKs, for the JWKS endpoint. Nothing
+        is published for the HMAC algorithms, their keys are secrets.
+        """
+        if self.algorithm.startswith("HS"):
+            return []
+
+        algorithm = jwt.PyJWS().get_algorithm_by_name(self.algorithm)
+        jwks = []
+        for kid in {**self.signing_keys, **self.verifying_keys}:
+            key = self.verifying_keys.get(kid) or self.signing_keys[kid].public_key()
+            jwk = algorithm.to_jwk(key, as_dict=True)
+            jwk.update(kid=kid, use="sig", alg=self.algorithm)
+            jwks.append(jwk)
+        return jwks
+
+    def get_verifying_key(self, token):
+        if self.jwks_client:
+            return super().get_verifying_key(token)
+
+        try:
+            kid = jwt.get_unverified_header(token).get("kid")
+        except jwt.InvalidTokenError:
+            kid = None
+        if kid in self.verifying_keys:
+            return self.verifying_keys[kid]
+        return self.verifying_keys.get(self.signing_kid)
+
     def encode(self, payload):
         """
         Returns an encoded token for the given payload dictionary.
@@ -20,10 +97,10 @@ class CustomTokenBackend(TokenBackend):
             jwt_payload["iss"] = self.issuer
         token = jwt.encode(
             jwt_payload,
-            self.signing_key,
+            self.signing_keys.get(self.signing_kid),
             algorithm=self.algorithm,
             json_encoder=self.json_encoder,
-            headers={"kid": "default"},
+            headers={"kid": self.signing_kid},
         )
 
         return token
@@ -38,6 +115,8 @@ token_backend = CustomTokenBackend(
     api_settings.JWK_URL,
     api_settings.LEEWAY,
     api_settings.JSON_ENCODER,
+    signing_kid=getattr(settings, "JWT_SIGNING_KID", "default"),
+    verifying_keys=getattr(settings, "JWT_VERIFYING_KEYS", None),
 )
 
 
@@ -56,6 +135,36 @@ class TokenVerifier:
 
 
 class CustomAccessToken(TokenVerifier, AccessToken):
+    def __init__(self, token=None, verify=True):
+        cache_key = self.get_cache_key(token) if verify else None
+        payload = verified_token_cache.get(cache_key) if cache_key else None
+        if payload is None:
+            super().__init__(token, verify)
+            if cache_key:
+                self.cache_payload(cache_key)
+            return
+
+        # Already verified for this tenant, skip the signature check
+        super().__init__(verify=False)
+        self.token = token
+        self.payload = payload.copy()
+
+    @staticmethod
+    def get_cache_key(token):
+        if token is None or not verified_token_cache.enabled:
+            return None
+        slug_name = getattr(getattr(connection, "tenant", None), "slug_name", None)
+        if not slug_name:
+            return None
+        if isinstance(token, str):
+            token = token.encode()
+        return slug_name, hashlib.sha256(token).digest()
+
+    def cache_payload(self, cache_key):
+        ttl = min(self.payload.get("exp", 0) - time.time(), verified_token_cache.ttl)
+        if ttl > 0:
+            verified_token_cache.set(cache_key, self.payload.copy(), ttl=ttl)
+
     @property
     def token_backend(self):
         if self._token_backend is None:
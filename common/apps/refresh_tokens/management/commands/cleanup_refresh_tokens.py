@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+from django_tenants.utils import (
+    get_public_schema_name,
+    get_tenant_model,
+    tenant_context,
+)
+
+from common.apps.refresh_tokens.services import delete_expired_token_families
+
+
+class Command(BaseCommand):
+    help = "Delete the expired and inactive refresh token families"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--organization", type=str, help="Organization slug, all by default"
+        )
+        parser.add_argument(
+            "--batch_size", type=int, default=1000, help="Families deleted per batch"
+        )
+
+    def handle(self, *args, **kwargs):
+        organizations = get_tenant_model().objects.exclude(
+            schema_name=get_public_schema_name()
+        )
+        if kwargs.get("organization"):
+            organizations = organizations.filter(schema_name=kwargs["organization"])
+
+        for organization in organizations:
+            total = 0
+            with tenant_context(organization):
+                for deleted in delete_expired_token_families(kwargs["batch_size"]):
+                    total += deleted
+                    self.stdout.write(
+                        f"{organization.schema_name}: deleted {total} families"
+                    )
+
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"{organization.schema_name}: {total} families deleted"
+                )
+            )
@@ -0,0 +1,19 @@
+# Generated by Django 5.0.6 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("refresh_tokens", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="refreshtoken",
+            name="jti",
+            field=models.CharField(
+                choices=[("New", "New"), ("Used", "Used")], max_length=32, unique=True
+            ),
+        ),
+    ]
@@ -25,7 +25,9 @@ class RefreshTokenFamily(BaseModel):
 
 
 class RefreshToken(BaseModel):
-    jti = models.CharField(max_length=32, choices=RefreshTokenStatus.choices)
+    jti = models.CharField(
+        max_length=32, choices=RefreshTokenStatus.choices, unique=True
+    )
     status = models.CharField(
         max_length=10,
         choices=RefreshTokenStatus.choices,
@@ -2,6 +2,7 @@ import logging
 
 from django.conf import settings
 from django.contrib.auth import authenticate, get_user_model
+from django.db import transaction
 from django.utils.module_loading import import_string
 from django.utils.translation import gettext_lazy as _
 from rest_framework import exceptions, serializers
@@ -12,12 +13,12 @@ from rest_framework_simplejwt.serializers import (
 )
 from rest_framework_simplejwt.settings import api_settings
 
-from common.apps.refresh_tokens.models import (
-    RefreshToken,
-    RefreshTokenFamilyStatus,
-    RefreshTokenStatus,
+from common.apps.refresh_tokens.services import (
+    create_jwt_tokens,
+    is_token_family_revoked,
+    reject_refresh_token,
+    rotate_refresh_token,
 )
-from common.apps.refresh_tokens.services import create_jwt_tokens
 from common.utils.social_provider import SocialProvider
 
 JWTRefreshToken = import_string(settings.REFRESH_TOKEN_CLASS)
@@ -75,23 +76,28 @@ class CustomTokenRefreshSerializer(TokenRefreshSerializer):
         if "request" in self.context and hasattr(self.context["request"], "tenant"):
             refresh.check_iss()
 
-        refresh_token_obj = (
-            RefreshToken.objects.filter(jti=refresh.payload[api_settings.JTI_CLAIM])
-            .select_related("family")
-            .first()
-        )
+        if is_token_family_revoked(refresh.payload):
+            raise TokenError(_("Refresh token is inactive"))
 
-        if not refresh_token_obj:
-            raise TokenError(_("Refresh token is not found"))
+        jti = refresh.payload[api_settings.JTI_CLAIM]
+        refresh.set_jti()
+        refresh.set_exp()
+        refresh.set_iat()
 
-        if refresh_token_obj.status != RefreshTokenStatus.New:
-            refresh_token_obj.family.status = RefreshTokenFamilyStatus.Inactive
-            refresh_token_obj.family.save()
-            raise TokenError(_("Refresh token is inactive"))
+        # Rolls the rotation back when the access token handler fails
+        with transaction.atomic():
+            rotated = rotate_refresh_token(jti, refresh.payload[api_settings.JTI_CLAIM])
+            if rotated:
+                data = self.get_access_data(refresh)
 
-        if refresh_token_obj.family.status != RefreshTokenFamilyStatus.Active:
-            raise TokenError(_("Refresh token is inactive"))
+        if not rotated:
+            reject_refresh_token(jti)
+
+        data["refresh"] = str(refresh)
+
+        return data
 
+    def get_access_data(self, refresh):
         if "access_token_handler" in self.context:
             params = {
                 "access_token": refresh.access_token,
@@ -99,26 +105,9 @@ class CustomTokenRefreshSerializer(TokenRefreshSerializer):
                 **self.context["access_token_handler_params"],
             }
             access = self.context["access_token_handler"](**params)
-            data = {"access": str(access)}
-        else:
-            data = {"access": str(refresh.access_token)}
+            return {"access": str(access)}
 
-        refresh.set_jti()
-        refresh.set_exp()
-        refresh.set_iat()
-
-        RefreshToken(
-            jti=refresh.payload[api_settings.JTI_CLAIM],
-            family=refresh_token_obj.family,
-            parent=refresh_token_obj,
-        ).save()
-
-        refresh_token_obj.status = RefreshTokenStatus.Used
-        refresh_token_obj.save()
-
-        data["refresh"] = str(refresh)
-
-        return data
+        return {"access": str(refresh.access_token)}
 
 
 class TokenPairSerializer(serializers.Serializer):
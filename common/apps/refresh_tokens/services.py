@@ -1,12 +1,34 @@
+import time
+import uuid
+
 from django.conf import settings
+from django.db import connection
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
 from django.utils.module_loading import import_string
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.exceptions import TokenError
 from rest_framework_simplejwt.settings import api_settings
 
-from common.apps.refresh_tokens.models import RefreshToken, RefreshTokenFamily
+from common.apps.refresh_tokens.models import (
+    RefreshToken,
+    RefreshTokenFamily,
+    RefreshTokenFamilyStatus,
+    RefreshTokenStatus,
+)
+from common.utils.cache import LRUCache
 from common.utils.subdomain import update_subdomain
 
 JWTRefreshToken = import_string(settings.REFRESH_TOKEN_CLASS)
 
+# (schema name, user id or None for the whole tenant) -> revocation time.
+# Lets this process reject the tokens of revoked families without a query,
+# the database stays the source of truth for the other processes.
+revocation_epochs = LRUCache(
+    max_size=getattr(settings, "REFRESH_TOKEN_REVOCATION_CACHE_MAX_SIZE", 10000),
+    ttl=api_settings.REFRESH_TOKEN_LIFETIME.total_seconds(),
+)
+
 
 def create_jwt_tokens(user, issuer=None, **kwargs):
     refresh = JWTRefreshToken.for_user(user)
@@ -23,3 +45,139 @@ def create_jwt_tokens(user, issuer=None, **kwargs):
     ).save()
 
     return refresh, refresh.access_token
+
+
+def _rotate_refresh_token_sql():
+    qn = connection.ops.quote_name
+    token_table = qn(RefreshToken._meta.db_table)
+    family_table = qn(RefreshTokenFamily._meta.db_table)
+    token = {
+        field.name: qn(field.column) for field in RefreshToken._meta.concrete_fields
+    }
+    family_id = qn(RefreshTokenFamily._meta.pk.column)
+    family_status = qn(RefreshTokenFamily._meta.get_field("status").column)
+
+    return f"""
+        WITH used AS (
+            UPDATE {token_table} AS token
+            SET {token["status"]} = %s, {token["updated_at"]} = %s
+            FROM {family_table} AS family
+            WHERE token.{token["family"]} = family.{family_id}
+                AND token.{token["jti"]} = %s
+                AND token.{token["status"]} = %s
+                AND family.{family_status} = %s
+            RETURNING token.{token["id"]} AS id, token.{token["family"]} AS family_id
+        )
+        INSERT INTO {token_table} (
+            {token["id"]}, {token["created_at"]}, {token["updated_at"]},
+            {token["jti"]}, {token["status"]}, {token["family"]}, {token["parent"]}
+        )
+        SELECT %s, %s, %s, %s, %s, used.family_id, used.id FROM used
+        RETURNING {token["id"]}
+    """  # nosec B608
+
+
+def rotate_refresh_token(jti, new_jti):
+    """
+    Mark the refresh token `jti` as used and create its child `new_jti` in a
+    single statement. Only a new token of an active family is rotated, so two
+    concurrent refreshes of the same token cannot both succeed.
+
+    Returns False when the token cannot be rotated, see reject_refresh_token.
+    """
+    now = timezone.now()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            _rotate_refresh_token_sql(),
+            [
+                RefreshTokenStatus.Used,
+                now,
+                jti,
+                RefreshTokenStatus.New,
+                RefreshTokenFamilyStatus.Active,
+                uuid.uuid4(),
+                now,
+                now,
+                new_jti,
+                RefreshTokenStatus.New,
+            ],
+        )
+        return cursor.fetchone() is not None
+
+
+def reject_refresh_token(jti):
+    """
+    Deactivate the family of a reused refresh token and raise TokenError.
+    Must not run in a transaction rolled back by the error.
+    """
+    deactivated = RefreshTokenFamily.objects.filter(
+        refreshtoken__jti=jti,
+        refreshtoken__status=RefreshTokenStatus.Used,
+    ).update(status=RefreshTokenFamilyStatus.Inactive)
+    if not deactivated and not RefreshToken.objects.filter(jti=jti).exists():
+        raise TokenError(_("Refresh token is not found"))
+    raise TokenError(_("Refresh token is inactive"))
+
+
+def delete_expired_token_families(batch_size=1000):
+    """
+    Delete the inactive families and the families without a token younger
+    than REFRESH_TOKEN_LIFETIME from the current schema, `batch_size`
+    families at a time. Yields the number of families deleted by each batch.
+    """
+    cutoff = timezone.now() - api_settings.REFRESH_TOKEN_LIFETIME
+    alive_tokens = RefreshToken.objects.filter(
+        family=OuterRef("pk"), created_at__gte=cutoff
+    )
+    queryset = RefreshTokenFamily.objects.filter(
+        Q(status=RefreshTokenFamilyStatus.Inactive) | ~Exists(alive_tokens)
+    )
+
+    while True:
+        ids = list(queryset.values_list("pk", flat=True)[:batch_size])
+        if not ids:
+            return
+        RefreshTokenFamily.objects.filter(pk__in=ids).delete()
+        yield len(ids)
+
+
+def revoke_user_token_families(user_id):
+    """
+    Deactivate every refresh token family of the user in the current schema,
+    returns the number of revoked families
+    """
+    revoked = RefreshTokenFamily.objects.filter(
+        user_id=user_id, status=RefreshTokenFamilyStatus.Active
+    ).update(status=RefreshTokenFamilyStatus.Inactive)
+    revocation_epochs.set((connection.schema_name, str(user_id)), time.time())
+    return revoked
+
+
+def revoke_tenant_token_families():
+    """
+    Deactivate every refresh token family of the current schema, returns the
+    number of revoked families
+    """
+    revoked = RefreshTokenFamily.objects.filter(
+        status=RefreshTokenFamilyStatus.Active
+    ).update(status=RefreshTokenFamilyStatus.Inactive)
+    revocation_epochs.set((connection.schema_name, None), time.time())
+    return revoked
+
+
+def is_token_family_revoked(payload):
+    """
+    Return True when the token was issued before a revocation of its user or
+    tenant made by this process. Tokens issued within the second of the
+    revocation are left to the database check.
+    """
+    issued_at = payload.get("iat")
+    if issued_at is None:
+        return False
+
+    user_id = payload.get(api_settings.USER_ID_CLAIM)
+    for key in ((connection.schema_name, None), (connection.schema_name, user_id)):
+        revoked_at = revocation_epochs.get(key)
+        if revoked_at is not None and issued_at < int(revoked_at):
+            return True
+    return False
@@ -0,0 +1,29 @@
+import logging
+
+from django_tenants.utils import (
+    get_public_schema_name,
+    get_tenant_model,
+    tenant_context,
+)
+
+from common.apps.refresh_tokens.services import delete_expired_token_families
+from common.celery.tasks import task
+
+logger = logging.getLogger(__name__)
+
+
+@task(name="spacedf.tasks.cleanup_refresh_tokens", max_retries=3)
+def cleanup_refresh_tokens(batch_size=1000):
+    """
+    Use in the Celery beat schedule to keep the refresh token tables small
+    """
+    organizations = get_tenant_model().objects.exclude(
+        schema_name=get_public_schema_name()
+    )
+    for organization in organizations:
+        with tenant_context(organization):
+            deleted = sum(delete_expired_token_families(batch_size=batch_size))
+        logger.info(
+            f"cleanup_refresh_tokens: deleted {deleted} families "
+            f"of {organization.schema_name}"
+        )
@@ -1,6 +1,11 @@
 from django.apps import AppConfig
 
+from common.models.synchronous_metadata import register_synchronous_models
+
 
 class SpaceConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "common.apps.space"
+
+    def ready(self):
+        register_synchronous_models(self)
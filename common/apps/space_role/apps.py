@@ -1,6 +1,11 @@
 from django.apps import AppConfig
 
+from common.models.synchronous_metadata import register_synchronous_models
+
 
 class SpaceRoleConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "common.apps.space_role"
+
+    def ready(self):
+        register_synchronous_models(self)
@@ -0,0 +1,46 @@
+class HeaderUser:
+    """
+    A lightweight user built from the trusted headers set by the gateway.
+
+    Only `id` (converted to the type of the user pk), `is_active`, `email`
+    and `is_owner` are available without a query, any other attribute loads
+    the full user through `loader` once and is read from it. It is not a
+    model instance, so it cannot be used as an ORM lookup value.
+    """
+
+    __slots__ = ("id", "is_active", "email", "is_owner", "_loader", "_user")
+
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, id, is_active, email, is_owner, loader):
+        self.id = id
+        self.is_active = is_active
+        self.email = email
+        self.is_owner = is_owner
+        self._loader = loader
+        self._user = None
+
+    @property
+    def pk(self):
+        return self.id
+
+    def get_user(self):
+        if self._user is None:
+            self._user = self._loader()
+        return self._user
+
+    def __getattr__(self, name):
+        # Only called for the attributes missing from the headers
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.get_user(), name)
+
+    def __str__(self):
+        return f"HeaderUser {self.id}"
+
+    def __eq__(self, other):
+        return getattr(other, "pk", None) == self.id
+
+    def __hash__(self):
+        return hash(self.id)
@@ -1,7 +1,9 @@
+from functools import partial
 from typing import TypeVar
 
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AbstractBaseUser
+from django.core.exceptions import ValidationError
 from django.utils.translation import gettext_lazy as _
 from rest_framework.authentication import BaseAuthentication
 from rest_framework.request import Request
@@ -9,11 +11,19 @@ from rest_framework_simplejwt.exceptions import AuthenticationFailed
 from rest_framework_simplejwt.models import TokenUser
 from rest_framework_simplejwt.settings import api_settings
 
-AuthUser = TypeVar("AuthUser", AbstractBaseUser, TokenUser)
+from common.authentication.header_user import HeaderUser
+from common.authentication.user_cache import user_cache
+
+AuthUser = TypeVar("AuthUser", AbstractBaseUser, TokenUser, HeaderUser)
+
+TRUE_VALUES = ("1", "true", "True")
 
 
 # TODO: replace JWTAuthentication by this on other service when ready
 class UserAuthentication(BaseAuthentication):
+    # Build the user from the gateway headers instead of the database
+    stateless = False
+
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
         self.user_model = get_user_model()
@@ -23,7 +33,11 @@ class UserAuthentication(BaseAuthentication):
         if not header:
             return None
 
-        user = self.get_user(header)
+        user = None
+        if self.stateless:
+            user = self.get_header_user(request, header)
+        if user is None:
+            user = self.get_user(header)
 
         if not user:
             return None
@@ -45,13 +59,63 @@ class UserAuthentication(BaseAuthentication):
     def get_user(self, user_id: str) -> AuthUser:
         """
         Attempts to find and return a user using the given `User Id`.
+        The user is served from the user cache when it is enabled.
         """
-        try:
-            user = self.user_model.objects.get(**{api_settings.USER_ID_FIELD: user_id})
-        except self.user_model.DoesNotExist:
-            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+        user = user_cache.get(user_id)
+        if user is None:
+            try:
+                user = self.user_model.objects.get(
+                    **{api_settings.USER_ID_FIELD: user_id}
+                )
+            except self.user_model.DoesNotExist:
+                raise AuthenticationFailed(_("User not found"), code="user_not_found")
+            user_cache.set(user_id, user)
 
         if not user.is_active:
             raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
 
         return user
+
+    def get_header_user(self, request: Request, user_id) -> HeaderUser:
+        """
+        Builds a lazy user from the `User Is Active`, `User Email` and
+        `User Is Owner` headers, returns None when one of them is missing.
+        """
+        is_active = request.META.get("user-is-active")
+        email = request.META.get("user-email")
+        is_owner = request.META.get("user-is-owner")
+        if is_active is None or email is None or is_owner is None:
+            return None
+
+        if is_active not in TRUE_VALUES:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+
+        if isinstance(user_id, bytes):
+            user_id = user_id.decode()
+        try:
+            # Same type as the pk of the user, e.g. uuid.UUID
+            user_id = self.user_model._meta.pk.to_python(user_id)
+        except ValidationError:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+
+        return HeaderUser(
+            id=user_id,
+            is_active=True,
+            email=email,
+            is_owner=is_owner in TRUE_VALUES,
+            loader=partial(self.get_user, user_id),
+        )
+
+
+class StatelessUserAuthentication(UserAuthentication):
+    """
+    Use on read-heavy endpoints that only need the identity of the user,
+    the user is only queried when a view reads an attribute the gateway
+    does not send.
+
+    `request.user` is then a HeaderUser, not a model instance: filter on
+    `request.user.id` instead of passing `request.user` as a lookup value or
+    assigning it to a foreign key.
+    """
+
+    stateless = True
@@ -0,0 +1,115 @@
+import copy
+import functools
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import connection, router, transaction
+
+from common.utils.cache import LRUCache
+
+# The password hash never leaves the database through the cache, it stays
+# deferred on the rebuilt user and is loaded on access
+EXCLUDED_FIELDS = ("password",)
+
+
+class UserCache:
+    """
+    Cache of slim user snapshots keyed by tenant schema and user id.
+
+    Snapshots are kept in an in-process LRU or, when
+    USER_AUTHENTICATION_CACHE_ALIAS is set, in that Django cache so the
+    processes of a service share them and their invalidation. The other
+    processes cannot invalidate the LRU, so it is only put in front of the
+    shared cache with USER_AUTHENTICATION_CACHE_LOCAL_TTL, which bounds how
+    stale its entries get.
+    """
+
+    def __init__(self):
+        self.ttl = getattr(settings, "USER_AUTHENTICATION_CACHE_TTL", 0)
+        self.alias = getattr(settings, "USER_AUTHENTICATION_CACHE_ALIAS", None)
+        self.local = LRUCache(
+            max_size=getattr(settings, "USER_AUTHENTICATION_CACHE_MAX_SIZE", 1024),
+            ttl=getattr(
+                settings,
+                "USER_AUTHENTICATION_CACHE_LOCAL_TTL",
+                0 if self.alias else self.ttl,
+            ),
+        )
+
+    @property
+    def enabled(self):
+        return bool(self.ttl)
+
+    @property
+    def shared(self):
+        return caches[self.alias] if self.alias else None
+
+    def make_key(self, user_id):
+        if isinstance(user_id, bytes):
+            user_id = user_id.decode()
+        # The header ids are strings, the model ids e.g. uuid.UUID
+        user_id = get_user_model()._meta.pk.to_python(user_id)
+        return f"user_authentication:{connection.schema_name}:{user_id}"
+
+    def get(self, user_id):
+        if not self.enabled:
+            return None
+
+        key = self.make_key(user_id)
+        snapshot = self.local.get(key)
+        if snapshot is None and self.shared is not None:
+            snapshot = self.shared.get(key)
+            if snapshot is not None:
+                self.local.set(key, snapshot)
+        if snapshot is None:
+            return None
+
+        # The mutable values, e.g. the array fields, are copied so a change
+        # to the rebuilt user does not leak into the cached snapshot
+        user_model = get_user_model()
+        field_names, values = snapshot
+        return user_model.from_db(
+            router.db_for_read(user_model), list(field_names), copy.deepcopy(values)
+        )
+
+    def set(self, user_id, user):
+        if not self.enabled:
+            return
+
+        fields = [
+            field
+            for field in user._meta.concrete_fields
+            if field.name not in EXCLUDED_FIELDS
+        ]
+        snapshot = (
+            tuple(field.attname for field in fields),
+            copy.deepcopy([getattr(user, field.attname) for field in fields]),
+        )
+        key = self.make_key(user_id)
+        self.local.set(key, snapshot)
+        if self.shared is not None:
+            self.shared.set(key, snapshot, timeout=self.ttl)
+
+    def delete(self, user_id):
+        self.delete_keys([self.make_key(user_id)])
+
+    def delete_on_commit(self, user_ids, using=None):
+        """
+        Drop the entries once the transaction commits, a request reading the
+        user before would cache the old row again. The keys hold the current
+        schema, the commit may happen in another.
+        """
+        if not self.enabled or not user_ids:
+            return
+        keys = [self.make_key(user_id) for user_id in user_ids]
+        transaction.on_commit(functools.partial(self.delete_keys, keys), using=using)
+
+    def delete_keys(self, keys):
+        for key in keys:
+            self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete_many(keys)
+
+
+user_cache = UserCache()
@@ -0,0 +1,88 @@
+import logging
+import time
+from functools import lru_cache
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+TIMING = "timing"
+HISTOGRAM = "histogram"
+INCREMENT = "increment"
+
+
+@lru_cache(maxsize=None)
+def get_metrics_hook():
+    """
+    SYNCHRONOUS_MODEL_METRICS_HOOK is the dotted path of a callable
+    `hook(kind, name, value, tags)`, kind being "timing" (seconds),
+    "histogram" or "increment", which maps directly to a statsd client.
+    """
+    hook_path = getattr(settings, "SYNCHRONOUS_MODEL_METRICS_HOOK", None)
+    if hook_path is None:
+        return None
+    return import_string(hook_path)
+
+
+def emit(kind, name, value, **tags):
+    hook = get_metrics_hook()
+    if hook is None:
+        return
+
+    try:
+        hook(kind, name, value, tags)
+    except Exception as e:
+        # The metrics never fail the replication
+        logger.exception(e)
+
+
+def record_replication(action, model_name, organization_slug_name, rows, meta, start):
+    """
+    Record the apply latency, the end-to-end lag from the producer stamp, the
+    batch size and the rows per tenant of a consumed replication message
+    """
+    tags = {"model": model_name, "action": action}
+    emit(TIMING, "synchronous_model.apply_latency", time.monotonic() - start, **tags)
+    if meta and meta.get("sent_at") is not None:
+        emit(TIMING, "synchronous_model.lag", time.time() - meta["sent_at"], **tags)
+    emit(HISTOGRAM, "synchronous_model.batch_size", rows, **tags)
+    emit(
+        INCREMENT,
+        "synchronous_model.rows",
+        rows,
+        organization=organization_slug_name,
+        **tags,
+    )
+
+
+class PrometheusMetricsHook:
+    """
+    Adapter exporting the metrics with prometheus_client, use
+    SYNCHRONOUS_MODEL_METRICS_HOOK = "common.celery.metrics.prometheus_metrics_hook"
+    """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def get_metric(self, kind, name, labels):
+        if name not in self.metrics:
+            import prometheus_client
+
+            metric_name = name.replace(".", "_")
+            if kind == INCREMENT:
+                metric = prometheus_client.Counter(metric_name, name, labels)
+            else:
+                metric = prometheus_client.Histogram(metric_name, name, labels)
+            self.metrics[name] = metric
+        return self.metrics[name]
+
+    def __call__(self, kind, name, value, tags):
+        metric = self.get_metric(kind, name, sorted(tags)).labels(**tags)
+        if kind == INCREMENT:
+            metric.inc(value)
+        else:
+            metric.observe(value)
+
+
+prometheus_metrics_hook = PrometheusMetricsHook()
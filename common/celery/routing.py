@@ -1,9 +1,107 @@
+from celery.signals import worker_init
+from django.apps import apps
 from django.conf import settings
 from django.utils.module_loading import import_string
 from kombu import Exchange, Queue
 
+from common.celery.serialization import register_synchronous_model_serializer
+from common.models.synchronous_metadata import get_synchronous_metadata
+
+
+def get_synchronous_model_shard_exchange(name):
+    """
+    The consistent-hash exchange of the service, bound to the fanout exchange
+    of the producer. It hashes the routing key, the organization slug name,
+    so the messages of a tenant always land in the same shard queue.
+    Requires the rabbitmq_consistent_hash_exchange plugin.
+    """
+    return Exchange(f"{settings.SERVICE_NAME}_{name}", type="x-consistent-hash")
+
+
+def bind_synchronous_model_shard_exchanges(**kwargs):
+    """
+    Bind the consistent-hash exchanges to the fanout exchanges on the broker,
+    kombu does not declare the exchange-to-exchange bindings
+    """
+    celery_app = import_string(settings.CELERY_APP)
+
+    with celery_app.connection_for_write() as connection:
+        channel = connection.default_channel
+        for model_name in settings.CLONE_MODELS:
+            for action in ("update", "delete"):
+                name = f"{action}_{model_name}"
+                exchange = Exchange(name, type="fanout", channel=channel)
+                exchange.declare()
+                shard_exchange = get_synchronous_model_shard_exchange(name)(channel)
+                shard_exchange.declare()
+                shard_exchange.bind_to(exchange)
+
+
+def is_synchronous_model_versioned(model_name):
+    """
+    Whether the consumer model has the SYNCHRONOUS_MODEL_VERSION_FIELD, unknown
+    (False) while the apps are not loaded
+    """
+    if not apps.ready:
+        return False
+
+    for model in apps.get_models():
+        if model._meta.model_name == model_name:
+            return get_synchronous_metadata(model).version_field is not None
+    return False
+
+
+def get_synchronous_model_queue_arguments(model_name):
+    """
+    The consumers skip the stale versions, so SYNCHRONOUS_MODEL_SINGLE_ACTIVE_CONSUMER
+    = False lets concurrent workers apply the updates. The models without the
+    version field, such as OrganizationUser which has no updated_at, keep a
+    single active consumer since nothing would order their messages. So do all
+    the models when the routing is set up before the apps are loaded.
+    The deltas are applied whatever the version of the row, and the deleted
+    rows are remembered in SYNCHRONOUS_MODEL_TOMBSTONE_CACHE_ALIAS, which
+    must be shared by the workers.
+    Changing the arguments of a declared queue requires deleting it on the
+    broker.
+    """
+    if getattr(
+        settings, "SYNCHRONOUS_MODEL_SINGLE_ACTIVE_CONSUMER", True
+    ) or not is_synchronous_model_versioned(model_name):
+        return {"x-single-active-consumer": True}
+    return {}
+
+
+def get_synchronous_model_queues(name, queue_arguments):
+    shards = getattr(settings, "SYNCHRONOUS_MODEL_SHARDS", 0)
+    if not shards:
+        return (
+            Queue(
+                f"{settings.SERVICE_NAME}_{name}",
+                exchange=Exchange(name, type="fanout"),
+                routing_key=name,
+                queue_arguments=queue_arguments,
+            ),
+        )
+
+    # Every shard keeps a single active consumer to preserve the order of the
+    # messages of its tenants, the routing key is the weight of the shard
+    return tuple(
+        Queue(
+            f"{settings.SERVICE_NAME}_{name}_{shard}",
+            exchange=get_synchronous_model_shard_exchange(name),
+            routing_key="1",
+            queue_arguments={"x-single-active-consumer": True},
+        )
+        for shard in range(shards)
+    )
+
 
 def setup_synchronous_model_task_routing():
+    """
+    Declare the queues of the models in CLONE_MODELS. With
+    SYNCHRONOUS_MODEL_SHARDS, each model gets that many queues sharded by
+    tenant instead of one queue for all the tenants.
+    """
     celery_app = import_string(settings.CELERY_APP)
 
     if celery_app.conf.task_queues is None:
@@ -12,35 +110,24 @@ def setup_synchronous_model_task_routing():
         celery_app.conf.task_routes = {}
 
     if hasattr(settings, "CLONE_MODELS"):
+        # Accept the replication messages of the producers using msgpack
+        register_synchronous_model_serializer()
+
         for model_name in settings.CLONE_MODELS:
-            celery_app.conf.task_queues = celery_app.conf.task_queues + (
-                Queue(
-                    f"{settings.SERVICE_NAME}_update_{model_name}",
-                    exchange=Exchange(f"update_{model_name}", type="fanout"),
-                    routing_key=f"update_{model_name}",
-                    queue_arguments={
-                        "x-single-active-consumer": True,
-                    },
-                ),
-                Queue(
-                    f"{settings.SERVICE_NAME}_delete_{model_name}",
-                    exchange=Exchange(f"delete_{model_name}", type="fanout"),
-                    routing_key=f"delete_{model_name}",
-                    queue_arguments={
-                        "x-single-active-consumer": True,
-                    },
-                ),
-            )
-            update_task_name = f"spacedf.tasks.update_{model_name}"
-            celery_app.conf.task_routes[update_task_name] = {
-                "queue": f"{settings.SERVICE_NAME}_update_{model_name}",
-                "routing_key": f"update_{model_name}",
-            }
-            delete_task_name = f"spacedf.tasks.delete_{model_name}"
-            celery_app.conf.task_routes[delete_task_name] = {
-                "queue": f"{settings.SERVICE_NAME}_delete_{model_name}",
-                "routing_key": f"delete_{model_name}",
-            }
+            for action in ("update", "delete"):
+                name = f"{action}_{model_name}"
+                queues = get_synchronous_model_queues(
+                    name, get_synchronous_model_queue_arguments(model_name)
+                )
+                celery_app.conf.task_queues = celery_app.conf.task_queues + queues
+                if len(queues) == 1:
+                    celery_app.conf.task_routes[f"spacedf.tasks.{name}"] = {
+                        "queue": queues[0].name,
+                        "routing_key": name,
+                    }
+
+        if getattr(settings, "SYNCHRONOUS_MODEL_SHARDS", 0):
+            worker_init.connect(bind_synchronous_model_shard_exchanges, weak=False)
 
 
 def setup_organization_task_routing():
@@ -0,0 +1,111 @@
+import datetime
+import decimal
+import uuid
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from kombu.serialization import registry
+
+# Requires the msgpack package, and zstandard for the compression
+SERIALIZER_NAME = "spacedf_msgpack"
+CONTENT_TYPE = "application/x-spacedf-msgpack"
+
+UUID_TYPE = 1
+DATETIME_TYPE = 2
+DATE_TYPE = 3
+DECIMAL_TYPE = 4
+
+# The first byte of a payload tells whether the rest is compressed
+RAW = b"\x00"
+ZSTD = b"\x01"
+
+
+def encode_ext(obj):
+    import msgpack
+
+    if isinstance(obj, uuid.UUID):
+        return msgpack.ExtType(UUID_TYPE, obj.bytes)
+    if isinstance(obj, datetime.datetime):
+        return msgpack.ExtType(DATETIME_TYPE, obj.isoformat().encode())
+    if isinstance(obj, datetime.date):
+        return msgpack.ExtType(DATE_TYPE, obj.isoformat().encode())
+    if isinstance(obj, decimal.Decimal):
+        return msgpack.ExtType(DECIMAL_TYPE, str(obj).encode())
+    if isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+    raise TypeError(f"Cannot serialize {type(obj)}")
+
+
+def decode_ext(code, data):
+    import msgpack
+
+    if code == UUID_TYPE:
+        return uuid.UUID(bytes=data)
+    if code == DATETIME_TYPE:
+        return datetime.datetime.fromisoformat(data.decode())
+    if code == DATE_TYPE:
+        return datetime.date.fromisoformat(data.decode())
+    if code == DECIMAL_TYPE:
+        return decimal.Decimal(data.decode())
+    return msgpack.ExtType(code, data)
+
+
+def dumps(obj):
+    """
+    Pack the message, compressed with zstd above
+    SYNCHRONOUS_MODEL_COMPRESSION_THRESHOLD bytes when it is set
+    """
+    import msgpack
+
+    payload = msgpack.packb(obj, default=encode_ext, use_bin_type=True)
+    threshold = getattr(settings, "SYNCHRONOUS_MODEL_COMPRESSION_THRESHOLD", None)
+    if threshold is not None and len(payload) > threshold:
+        import zstandard
+
+        return ZSTD + zstandard.ZstdCompressor().compress(payload)
+    return RAW + payload
+
+
+def loads(payload):
+    import msgpack
+
+    if isinstance(payload, str):
+        payload = payload.encode("latin-1")
+    flag, payload = payload[:1], payload[1:]
+    if flag == ZSTD:
+        import zstandard
+
+        payload = zstandard.ZstdDecompressor().decompress(payload)
+    return msgpack.unpackb(payload, ext_hook=decode_ext, raw=False)
+
+
+def register_synchronous_model_serializer():
+    """
+    Register the codec with kombu and accept it on the Celery app. The
+    consumers must accept it before the producers switch to it.
+    """
+    registry.register(
+        SERIALIZER_NAME,
+        dumps,
+        loads,
+        content_type=CONTENT_TYPE,
+        content_encoding="binary",
+    )
+
+    celery_app = import_string(settings.CELERY_APP)
+    accept_content = list(celery_app.conf.accept_content or ["json"])
+    if CONTENT_TYPE not in accept_content and SERIALIZER_NAME not in accept_content:
+        celery_app.conf.accept_content = accept_content + [CONTENT_TYPE]
+
+
+def get_synchronous_message_options():
+    """
+    The publish options of the replication messages, msgpack is opt-in with
+    SYNCHRONOUS_MODEL_SERIALIZER = "msgpack"
+    """
+    if getattr(settings, "SYNCHRONOUS_MODEL_SERIALIZER", "json") != "msgpack":
+        return {}
+
+    if CONTENT_TYPE not in registry.type_to_name:
+        register_synchronous_model_serializer()
+    return {"serializer": SERIALIZER_NAME}
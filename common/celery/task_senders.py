@@ -1,17 +1,191 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from functools import cached_property
+
 from django.conf import settings
 from django.utils.module_loading import import_string
+from kombu.pools import ProducerPool
+
+logger = logging.getLogger(__name__)
+
+RETRY_POLICY = dict(max_retries=3, interval_start=3, interval_step=1, interval_max=6)
+
+
+class TaskSender:
+    """
+    Publishes the tasks through a producer pool of the process.
+
+    With TASK_SENDER_NON_BLOCKING the tasks are put in a bounded buffer
+    (TASK_SENDER_BUFFER_SIZE) and published by a background thread, so a
+    broker hiccup does not block the caller. A full buffer blocks the caller
+    up to TASK_SENDER_BUFFER_TIMEOUT seconds, then the task is dropped and
+    counted, it is never published ahead of the buffered ones. Use the outbox
+    when the messages must not be lost.
+    """
+
+    def __init__(self):
+        self.pool_limit = getattr(settings, "TASK_SENDER_POOL_LIMIT", 10)
+        self.non_blocking = getattr(settings, "TASK_SENDER_NON_BLOCKING", False)
+        self.buffer_size = getattr(settings, "TASK_SENDER_BUFFER_SIZE", 1000)
+        self.buffer_timeout = getattr(settings, "TASK_SENDER_BUFFER_TIMEOUT", 5)
+        self.flush_timeout = getattr(settings, "TASK_SENDER_FLUSH_TIMEOUT", 10)
+        self.lock = threading.Lock()
+        self.pid = None
+        self.reset_counters()
+
+    @cached_property
+    def app(self):
+        return import_string(settings.CELERY_APP)
+
+    def setup(self):
+        """
+        Create the pool and the buffer of the process, again after a fork
+        """
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.producer_pool = ProducerPool(self.app.pool, limit=self.pool_limit)
+            self.buffer = queue.Queue(maxsize=self.buffer_size)
+            self.thread = None
+            self.pid = os.getpid()
+
+    def start_flush_thread(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(
+                    target=self.run_flush_thread, name="task-sender", daemon=True
+                )
+                self.thread.start()
+
+    def run_flush_thread(self):
+        while True:
+            name, message, routing_key, kwargs = self.buffer.get()
+            try:
+                self.publish(name, message, routing_key, **kwargs)
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                self.buffer.task_done()
+
+    def flush(self, timeout=None):
+        """
+        Wait for the buffered tasks to be published, at most `timeout` seconds.
+        Return whether the buffer was emptied.
+        """
+        if self.pid != os.getpid() or self.thread is None:
+            return True
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.buffer.all_tasks_done:
+            while self.buffer.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.buffer.all_tasks_done.wait(remaining)
+        return True
+
+    def close(self):
+        """
+        Flush the buffer at exit within TASK_SENDER_FLUSH_TIMEOUT seconds, a
+        broker down would otherwise retry every buffered task. The tasks left
+        are dropped and counted.
+        """
+        if self.flush(timeout=self.flush_timeout):
+            return
+
+        dropped = 0
+        while True:
+            try:
+                self.buffer.get_nowait()
+            except queue.Empty:
+                break
+            self.buffer.task_done()
+            dropped += 1
+        with self.lock:
+            self.counters["dropped"] += dropped
+        logger.error(f"Drop {dropped} buffered tasks, the task sender did not flush")
+
+    def publish(self, name, message, routing_key=None, **kwargs):
+        start = time.monotonic()
+        try:
+            if "producer" in kwargs:
+                result = self.send(name, message, routing_key, **kwargs)
+            else:
+                with self.producer_pool.acquire(block=True) as producer:
+                    result = self.send(
+                        name, message, routing_key, producer=producer, **kwargs
+                    )
+        except Exception:
+            with self.lock:
+                self.counters["failed"] += 1
+            raise
+
+        latency = time.monotonic() - start
+        with self.lock:
+            self.counters["published"] += 1
+            self.counters["latency_total"] += latency
+            self.counters["latency_max"] = max(self.counters["latency_max"], latency)
+        return result
+
+    def send(self, name, message, routing_key=None, **kwargs):
+        return self.app.send_task(
+            name=f"spacedf.tasks.{name}",
+            exchange=name,
+            routing_key=routing_key or f"spacedf.tasks.{name}",
+            retry=True,
+            retry_policy=RETRY_POLICY,
+            kwargs=message,
+            **kwargs,
+        )
+
+    def send_task(self, name, message, routing_key=None, block=None, **kwargs):
+        self.setup()
+        if block is None:
+            block = not self.non_blocking or "producer" in kwargs
+        if block:
+            return self.publish(name, message, routing_key, **kwargs)
+
+        self.start_flush_thread()
+        try:
+            self.buffer.put(
+                (name, message, routing_key, kwargs), timeout=self.buffer_timeout
+            )
+        except queue.Full:
+            with self.lock:
+                self.counters["dropped"] += 1
+            logger.error(f"Drop the task {name}, the task sender buffer is full")
+
+    def reset_counters(self):
+        self.counters = {
+            "published": 0,
+            "failed": 0,
+            "dropped": 0,
+            "latency_total": 0.0,
+            "latency_max": 0.0,
+        }
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats["buffered"] = self.buffer.qsize() if self.pid == os.getpid() else 0
+        stats["latency_avg"] = (
+            stats["latency_total"] / stats["published"] if stats["published"] else 0.0
+        )
+        return stats
+
+
+task_sender = TaskSender()
+atexit.register(task_sender.close)
 
 
-def send_task(name, message, **kwargs):
-    celery_app = import_string(settings.CELERY_APP)
-    return celery_app.send_task(
-        name=f"spacedf.tasks.{name}",
-        exchange=name,
-        routing_key=f"spacedf.tasks.{name}",
-        retry=True,
-        retry_policy=dict(
-            max_retries=3, interval_start=3, interval_step=1, interval_max=6
-        ),
-        kwargs=message,
-        **kwargs,
-    )
+def send_task(name, message, routing_key=None, **kwargs):
+    """
+    Publish the task to the exchange of the same name. The routing key is
+    ignored by the fanout exchanges, the tenant messages set it to the
+    organization so the sharded consumers can hash on it.
+    """
+    return task_sender.send_task(name, message, routing_key=routing_key, **kwargs)
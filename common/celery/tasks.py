@@ -1,11 +1,28 @@
 import logging
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
 
 from celery import shared_task
-from django.db import models, transaction
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import connection, models, transaction
 from django_tenants.utils import get_tenant_model, tenant_context
 
+from common.authentication.user_cache import user_cache
+from common.celery.metrics import record_replication
+from common.models.synchronous_metadata import get_synchronous_metadata
+from common.utils.cache import LRUCache
+
 logger = logging.getLogger(__name__)
 
+# Schema name -> tenant, invalidated by the tasks in common.apps.organization
+task_tenant_cache = LRUCache(
+    max_size=getattr(settings, "TENANT_CACHE_MAX_SIZE", 1024),
+    ttl=getattr(settings, "TENANT_TASK_CACHE_TTL", 300),
+)
+
 
 def task(max_retries=3, bind=False, task_acks_late=True, prefetch_count=1, **option):
     """
@@ -37,6 +54,29 @@ def task(max_retries=3, bind=False, task_acks_late=True, prefetch_count=1, **opt
     return create_shared_task
 
 
+def get_task_tenant(schema_name):
+    """
+    Return the tenant of the schema, cached in the worker process. Missing
+    tenants are not cached, the message is retried until the organization
+    is created.
+    """
+    tenant = task_tenant_cache.get(schema_name)
+    if tenant is None:
+        tenant = get_tenant_model().objects.get(schema_name=schema_name)
+        task_tenant_cache.set(schema_name, tenant)
+    return tenant
+
+
+def get_tombstone_cache():
+    """
+    The Django cache remembering the deleted rows, it must be shared by the
+    workers consuming the same queues
+    """
+    return caches[
+        getattr(settings, "SYNCHRONOUS_MODEL_TOMBSTONE_CACHE_ALIAS", "default")
+    ]
+
+
 def tenant_shared_task(**option):
     """
     Use as a decorator for the Celery shared_task to handle the model of tenant
@@ -46,9 +86,7 @@ def tenant_shared_task(**option):
         @task(**option)
         @transaction.atomic
         def tenant_handle(organization_slug_name, **kwargs):
-            organization = get_tenant_model().objects.get(
-                schema_name=organization_slug_name
-            )
+            organization = get_task_tenant(organization_slug_name)
             with tenant_context(organization):
                 return handler(**kwargs)
 
@@ -61,35 +99,344 @@ def create_tenant_model_shared_tasks(Model):
     """
     This function create the Celery shared_task to listen the update and delete event
     """
+    metadata = get_synchronous_metadata(Model)
+    foreign_keys = metadata.foreign_keys
+    many_to_many_fields = metadata.many_to_many_by_name
 
-    @tenant_shared_task(name=f"spacedf.tasks.update_{Model._meta.model_name}")
-    def update(data):
-        cloned_data = data.copy()
-
-        many_to_many_fields = {}
-        for field in Model._meta.get_fields():
-            if isinstance(field, models.ForeignKey) and field.name in cloned_data:
-                key = f"{field.name}_id"
-                value = cloned_data.pop(field.name, None)
-                cloned_data[key] = value
-            if isinstance(field, models.ManyToManyField) and field.name in cloned_data:
-                value = cloned_data.pop(field.name, None)
-                many_to_many_fields[field.name] = value
+    def split_row(data):
+        """
+        Split the row into the model values and the many-to-many values
+        """
+        values = {}
+        many_to_many = {}
+        for key, value in data.items():
+            if key in many_to_many_fields:
+                many_to_many[key] = value
+            else:
+                values[foreign_keys.get(key, key)] = value
+        return values, many_to_many
+
+    def invalidate_user_cache(pks):
+        # The bulk writes do not send the signals that invalidate the cache
+        if Model is get_user_model():
+            user_cache.delete_on_commit(list(pks))
+
+    def set_many_to_many(field_name, rows):
+        """
+        Replace the through rows of the many-to-many field for the given
+        {pk: [related pk]} in two queries
+        """
+        field = many_to_many_fields[field_name]
+        through = field.remote_field.through
+        source = through._meta.get_field(field.m2m_field_name()).attname
+        target = through._meta.get_field(field.m2m_reverse_field_name()).attname
+
+        through.objects.filter(**{f"{source}__in": list(rows)}).delete()
+        through.objects.bulk_create(
+            [
+                through(**{source: pk, target: related_pk})
+                for pk, related_pks in rows.items()
+                for related_pk in related_pks or []
+            ],
+            ignore_conflicts=True,
+        )
+
+    # Rows carry the version of the producer, older versions are skipped so
+    # the messages can be applied concurrently and more than once
+    version_field = metadata.version_field
+
+    def get_version(values):
+        if version_field is None or values.get(version_field.attname) is None:
+            return None
+        version = version_field.to_python(values[version_field.attname])
+        values[version_field.attname] = version
+        return version
+
+    def is_stale(current_version, version):
+        return None not in (current_version, version) and current_version > version
+
+    # The versioned models may be consumed concurrently, the deleted rows are
+    # remembered for SYNCHRONOUS_MODEL_TOMBSTONE_TTL seconds so an update
+    # delivered after the delete does not create the row again. The models
+    # without version keep a single active consumer and may be created again.
+    tombstone_ttl = getattr(settings, "SYNCHRONOUS_MODEL_TOMBSTONE_TTL", 86400)
+
+    def make_tombstone_key(pk):
+        pk = Model._meta.pk.to_python(pk)
+        return (
+            f"synchronous_model_tombstone:{connection.schema_name}:"
+            f"{metadata.model_name}:{pk}"
+        )
+
+    def set_tombstones(deleted_versions):
+        """
+        Remember the deleted rows with the {pk: version} of their delete, None
+        when it is unknown
+        """
+        if version_field is None or not deleted_versions:
+            return
+        get_tombstone_cache().set_many(
+            {
+                make_tombstone_key(pk): {"version": version}
+                for pk, version in deleted_versions.items()
+            },
+            timeout=tombstone_ttl,
+        )
+
+    def get_deleted_pks(versions):
+        """
+        The pks of the {pk: version} of missing rows whose delete is newer
+        """
+        if version_field is None or not versions:
+            return set()
+        keys = {make_tombstone_key(pk): pk for pk in versions}
+        tombstones = get_tombstone_cache().get_many(list(keys))
+        return {
+            pk
+            for key, pk in keys.items()
+            if key in tombstones
+            and (
+                None in (versions[pk], tombstones[key]["version"])
+                or versions[pk] <= tombstones[key]["version"]
+            )
+        }
+
+    def get_delete_version(meta):
+        """
+        The producer stamps the delete after it happened, so the stamp is newer
+        than every version of the row before the delete
+        """
+        if not isinstance(version_field, models.DateTimeField):
+            return None
+        if not meta or meta.get("sent_at") is None:
+            return None
+        return datetime.fromtimestamp(meta["sent_at"], timezone.utc)
+
+    def restore_versions(objs, versions):
+        """
+        Write back the versions of the producer, which auto_now replaced on save
+        """
+        if not getattr(version_field, "auto_now", False):
+            return
+        objs = [obj for obj in objs if versions.get(obj.pk) is not None]
+        for obj in objs:
+            setattr(obj, version_field.attname, versions[obj.pk])
+        Model.objects.bulk_update(objs, [version_field.name])
+
+    def update_row(data, partial=False):
+        values, many_to_many = split_row(data)
+        version = get_version(values)
         try:
-            obj = Model.objects.get(id=cloned_data["id"])
-            for attr, value in cloned_data.items():
-                setattr(obj, attr, value)
+            obj = Model.objects.select_for_update().get(id=values["id"])
         except Model.DoesNotExist:
-            obj = Model(**cloned_data)
+            if get_deleted_pks({values["id"]: version}):
+                logger.info(
+                    f"Skip the update of the deleted "
+                    f"{Model._meta.model_name} {values['id']}"
+                )
+                return
+            if partial:
+                # The delta overtook the create of the row, the task is retried
+                raise Model.DoesNotExist(
+                    f"Partial update of the missing "
+                    f"{Model._meta.model_name} {values['id']}"
+                )
+            obj = Model(**values)
+        else:
+            if version is not None and is_stale(
+                getattr(obj, version_field.attname), version
+            ):
+                if not partial:
+                    logger.info(
+                        f"Skip the stale update of the {Model._meta.model_name} {obj.pk}"
+                    )
+                    return
+                # A delta only holds the fields it changed, the newer version of
+                # the row may come from other fields. Its fields are applied,
+                # the version of the row is kept.
+                del values[version_field.attname]
+                version = None
+            for attr, value in values.items():
+                setattr(obj, attr, value)
+
+        if partial:
+            # Only write the changed columns
+            obj.save(update_fields=[key for key in values if key != "id"])
+        else:
+            obj.save()
+        restore_versions([obj], {obj.pk: version})
 
-        for field, value in many_to_many_fields.items():
-            getattr(obj, field).set(value)
+        # The related rows need the saved object
+        for field_name, value in many_to_many.items():
+            getattr(obj, field_name).set(value)
 
-        obj.save()
+    def lock_rows(pks):
+        """
+        Hold a lock per row until the commit. The staleness check cannot see
+        the rows inserted by a concurrent batch not committed yet, whose
+        upsert would then win whatever its version.
+        """
+        keys = [f"{connection.schema_name}.{Model._meta.db_table}:{pk}" for pk in pks]
+        with connection.cursor() as cursor:
+            # Locked in the order of the lock ids, so two batches cannot deadlock
+            cursor.execute(
+                "SELECT pg_advisory_xact_lock(lock_id) FROM ("
+                "SELECT DISTINCT hashtextextended(key, 0) AS lock_id "
+                "FROM unnest(%s::text[]) AS key"
+                ") AS lock_ids ORDER BY lock_id",
+                [keys],
+            )
+
+    def update_rows(rows):
+        """
+        Upsert the full rows with one INSERT ... ON CONFLICT per batch and
+        replace their many-to-many rows in bulk
+        """
+        objs = {}
+        versions = {}
+        many_to_many = defaultdict(dict)
+        update_fields = set()
+        for row in rows:
+            values, row_many_to_many = split_row(row)
+            pk = values["id"] = Model._meta.pk.to_python(values["id"])
+            # The last state of a row wins
+            objs[pk] = Model(**values)
+            versions[pk] = get_version(values)
+            update_fields.update(key for key in values if key != "id")
+            for field_name, value in row_many_to_many.items():
+                many_to_many[field_name][pk] = value
+
+        def skip_row(pk, reason):
+            logger.info(
+                f"Skip the {reason} update of the {Model._meta.model_name} {pk}"
+            )
+            del objs[pk]
+            for field_rows in many_to_many.values():
+                field_rows.pop(pk, None)
+
+        if version_field is not None:
+            lock_rows(objs)
+            current_versions = dict(
+                Model.objects.select_for_update()
+                .filter(pk__in=list(objs))
+                .values_list("pk", version_field.attname)
+            )
+            for pk, current_version in current_versions.items():
+                if is_stale(current_version, versions[pk]):
+                    skip_row(pk, "stale")
+            missing_versions = {
+                pk: version
+                for pk, version in versions.items()
+                if pk not in current_versions
+            }
+            for pk in get_deleted_pks(missing_versions):
+                skip_row(pk, "deleted")
+        if not objs:
+            return
+
+        # bulk_create runs pre_save(add=True), auto_now_add would replace the
+        # creation time of the existing rows like save() never does on update
+        update_fields = [
+            Model._meta.get_field(key)
+            for key in update_fields
+            if not getattr(Model._meta.get_field(key), "auto_now_add", False)
+        ]
+        Model.objects.bulk_create(
+            list(objs.values()),
+            batch_size=getattr(settings, "SYNCHRONOUS_MODEL_BATCH_SIZE", 500),
+            update_conflicts=True,
+            unique_fields=["id"],
+            update_fields=[field.name for field in update_fields],
+        )
+        restore_versions(objs.values(), versions)
+        for field_name, field_rows in many_to_many.items():
+            set_many_to_many(field_name, field_rows)
+        invalidate_user_cache(objs)
+
+    def delete_missing_rows(rows, snapshot):
+        """
+        Delete the rows of the snapshot key range missing from the snapshot.
+        The rows changed after the snapshot started are kept, they may have
+        been created since. Without a version field nothing tells them apart,
+        so the missing rows of those models are not deleted.
+        """
+        if version_field is None:
+            logger.warning(
+                f"Skip the deletion of the rows missing from the snapshot of the "
+                f"{Model._meta.model_name}, it has no version field"
+            )
+            return
+
+        started_at = datetime.fromtimestamp(snapshot["started_at"], timezone.utc)
+        objs = Model.objects.exclude(pk__in=[row["id"] for row in rows]).filter(
+            **{f"{version_field.attname}__lt": started_at}
+        )
+        if snapshot.get("after") is not None:
+            objs = objs.filter(pk__gt=snapshot["after"])
+        if snapshot.get("until") is not None:
+            objs = objs.filter(pk__lte=snapshot["until"])
+
+        pks = list(objs.values_list("pk", flat=True))
+        if pks:
+            Model.objects.filter(pk__in=pks).delete()
+            set_tombstones(dict.fromkeys(pks, started_at))
+            invalidate_user_cache(pks)
+
+    @tenant_shared_task(name=f"spacedf.tasks.update_{Model._meta.model_name}")
+    def update(data, partial=False, meta=None, snapshot=None):
+        start = time.monotonic()
+        # A list of rows is sent when the producer coalesces its messages, a
+        # partial row only holds the changed fields
+        if snapshot is not None:
+            update_rows(data)
+            delete_missing_rows(data, snapshot)
+        elif isinstance(data, list) and not partial:
+            update_rows(data)
+        elif isinstance(data, list):
+            for row in data:
+                update_row(row, partial)
+        else:
+            update_row(data, partial)
+
+        record_replication(
+            "update",
+            metadata.model_name,
+            connection.schema_name,
+            len(data) if isinstance(data, list) else 1,
+            meta,
+            start,
+        )
 
     @tenant_shared_task(name=f"spacedf.tasks.delete_{Model._meta.model_name}")
-    def delete(pk):
-        obj = Model.objects.get(pk=pk)
-        obj.delete()
+    def delete(pk, meta=None):
+        start = time.monotonic()
+        # A list is sent when the producer coalesces its messages. The rows may
+        # have been created in the same transaction, and a redelivered delete
+        # finds nothing to delete.
+        pks = [
+            Model._meta.pk.to_python(pk)
+            for pk in (pk if isinstance(pk, list) else [pk])
+        ]
+        delete_version = get_delete_version(meta)
+        deleted_versions = dict.fromkeys(pks, delete_version)
+        for obj in Model.objects.select_for_update().filter(pk__in=pks):
+            if version_field is not None:
+                version = getattr(obj, version_field.attname)
+                if is_stale(version, delete_version):
+                    # Only a row created again with the same pk is newer
+                    logger.info(
+                        f"Skip the stale delete of the {Model._meta.model_name} {obj.pk}"
+                    )
+                    del deleted_versions[obj.pk]
+                    continue
+                if delete_version is None:
+                    deleted_versions[obj.pk] = version
+            obj.delete()
+        set_tombstones(deleted_versions)
+        invalidate_user_cache(pks)
+
+        record_replication(
+            "delete", metadata.model_name, connection.schema_name, len(pks), meta, start
+        )
 
     return update, delete
@@ -1,20 +1,29 @@
 from django.conf import settings
 from django.core.exceptions import DisallowedHost
-from django.db import connection
 from django_tenants.middleware import TenantMainMiddleware
 from django_tenants.utils import get_tenant_domain_model
 
+from common.utils.cache import LRUCache
+from common.utils.switch_tenant import (
+    set_connection_schema_to_public,
+    set_connection_tenant,
+)
+
+TENANT_NOT_FOUND = object()
+
+# Hostname -> tenant, invalidated by the signals in common.apps.organization
+hostname_tenant_cache = LRUCache(
+    max_size=getattr(settings, "TENANT_CACHE_MAX_SIZE", 1024),
+    ttl=getattr(settings, "TENANT_CACHE_TTL", 300),
+)
+
 
 class TenantMiddleware(TenantMainMiddleware):
     def process_request(self, request):
-        # Connection needs first to be at the public schema, as this is where
-        # the tenant metadata is stored.
-
         if request.path.startswith(settings.STATIC_URL):
             return
 
         if not request.path.startswith(tuple(settings.PUBLIC_PATHS)):
-            connection.set_schema_to_public()
             try:
                 hostname = self.hostname_from_request(request)
             except DisallowedHost:
@@ -22,15 +31,42 @@ class TenantMiddleware(TenantMainMiddleware):
 
                 return HttpResponseNotFound()
 
-            domain_model = get_tenant_domain_model()
-            try:
-                tenant = self.get_tenant(domain_model, hostname)
-            except domain_model.DoesNotExist:
+            tenant = self.get_cached_tenant(hostname)
+            if tenant is TENANT_NOT_FOUND:
+                set_connection_schema_to_public()
                 self.no_tenant_found(request, hostname)
                 return
 
             tenant.domain_url = hostname
             request.tenant = tenant
-            connection.set_tenant(request.tenant)
+            set_connection_tenant(request.tenant)
 
         self.setup_url_routing(request)
+
+    def get_cached_tenant(self, hostname):
+        """
+        Resolve the tenant of the hostname, hitting the database only on a
+        cache miss. Unknown hostnames are cached as well (for a shorter time)
+        so that scanners cannot hammer the database.
+        """
+        tenant = hostname_tenant_cache.get(hostname)
+        if tenant is not None:
+            return tenant
+
+        # Connection needs first to be at the public schema, as this is where
+        # the tenant metadata is stored.
+        set_connection_schema_to_public()
+
+        domain_model = get_tenant_domain_model()
+        try:
+            tenant = self.get_tenant(domain_model, hostname)
+        except domain_model.DoesNotExist:
+            hostname_tenant_cache.set(
+                hostname,
+                TENANT_NOT_FOUND,
+                ttl=getattr(settings, "TENANT_CACHE_NOT_FOUND_TTL", 30),
+            )
+            return TENANT_NOT_FOUND
+
+        hostname_tenant_cache.set(hostname, tenant)
+        return tenant
@@ -0,0 +1,102 @@
+from itertools import chain
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import models
+from django.dispatch import receiver
+
+# Model -> SynchronousModelMetadata, filled at app-ready
+synchronous_model_metadata = {}
+
+
+class SynchronousModelMetadata:
+    """
+    What the producer and the consumers need to know about a replicated
+    model, computed once instead of scanning `_meta` on every message
+    """
+
+    def __init__(self, model):
+        opts = model._meta
+        self.model_name = opts.model_name
+        self.pk_name = opts.pk.name
+        self.enabled = opts.model_name in getattr(settings, "SYNCHRONOUS_MODEL", ())
+
+        synchronous_fields = getattr(model, "synchronous_fields", None)
+        if synchronous_fields is None:
+            synchronous_fields = [field.name for field in opts.get_fields()]
+        self.field_names = tuple(synchronous_fields)
+
+        # Same order as model_to_dict
+        self.fields = tuple(
+            field
+            for field in chain(opts.concrete_fields, opts.private_fields)
+            if field.name in self.field_names
+        )
+        self.concrete_fields = tuple(
+            field for field in opts.concrete_fields if field.name in self.field_names
+        )
+        self.many_to_many = tuple(
+            field for field in opts.many_to_many if field.name in self.field_names
+        )
+        self.has_updated_at = any(
+            field.name == "updated_at" for field in opts.concrete_fields
+        )
+
+        # The consumer side maps the replicated names to the columns
+        self.foreign_keys = {
+            field.name: field.attname
+            for field in opts.get_fields()
+            if isinstance(field, models.ForeignKey)
+        }
+        self.many_to_many_by_name = {
+            field.name: field
+            for field in opts.get_fields()
+            if isinstance(field, models.ManyToManyField)
+        }
+        version_field_name = getattr(
+            settings, "SYNCHRONOUS_MODEL_VERSION_FIELD", "updated_at"
+        )
+        self.version_field = next(
+            (
+                field
+                for field in opts.concrete_fields
+                if field.name == version_field_name
+            ),
+            None,
+        )
+
+    def serialize(self, instance):
+        data = {field.name: field.value_from_object(instance) for field in self.fields}
+        for field in self.many_to_many:
+            data[field.name] = [i.id for i in field.value_from_object(instance)]
+        return data
+
+
+def get_synchronous_metadata(model):
+    """
+    Return the metadata of the model, built on first use for the models not
+    registered at app-ready
+    """
+    model = model._meta.model
+    metadata = synchronous_model_metadata.get(model)
+    if metadata is None:
+        metadata = synchronous_model_metadata[model] = SynchronousModelMetadata(model)
+    return metadata
+
+
+def register_synchronous_models(app_config):
+    """
+    Build the metadata of the synchronous models of the app, call it from
+    AppConfig.ready
+    """
+    from common.models.synchronous_model import SynchronousTenantModel
+
+    for model in app_config.get_models():
+        if issubclass(model, SynchronousTenantModel):
+            get_synchronous_metadata(model)
+
+
+@receiver(setting_changed)
+def clear_synchronous_metadata(setting, **kwargs):
+    if setting.startswith("SYNCHRONOUS_MODEL"):
+        synchronous_model_metadata.clear()
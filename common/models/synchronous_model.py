@@ -1,8 +1,392 @@
+import contextlib
+import copy
+import functools
+import itertools
+import os
+import time
+import weakref
+from collections import defaultdict
+
 from django.conf import settings
-from django.db import connection, models
+from django.contrib.auth import get_user_model
+from django.db import connection, models, router, transaction
+from django.db.models.signals import m2m_changed
+from django.dispatch import receiver
+from django.utils import timezone
 
+from common.authentication.user_cache import user_cache
+from common.celery.serialization import get_synchronous_message_options
 from common.celery.task_senders import send_task
-from common.utils.model_to_dict import model_to_dict
+from common.models.synchronous_metadata import get_synchronous_metadata
+from common.utils.keyset import iterate_keyset_batches
+
+DELETED = object()
+
+message_sequence = itertools.count(1)
+
+
+def get_synchronous_message_meta():
+    """
+    The producer stamp of the replication messages, used by the consumers to
+    measure the lag. The sequence increases per producer process.
+    """
+    return {
+        "sent_at": time.time(),
+        "sequence": next(message_sequence),
+        "producer": f"{getattr(settings, 'SERVICE_NAME', '')}:{os.getpid()}",
+    }
+
+
+def send_synchronous_message(name, message):
+    """
+    Publish a replication message, or write it to the outbox in the current
+    transaction when SYNCHRONOUS_MODEL_OUTBOX is enabled. The consumers must
+    accept the `meta` stamp before SYNCHRONOUS_MODEL_STAMP_MESSAGES is enabled.
+    """
+    if getattr(settings, "SYNCHRONOUS_MODEL_STAMP_MESSAGES", False):
+        message = {**message, "meta": get_synchronous_message_meta()}
+
+    if getattr(settings, "SYNCHRONOUS_MODEL_OUTBOX", False):
+        from common.apps.outbox.models import OutboxMessage
+
+        OutboxMessage.objects.create(name=name, message=message)
+        return
+
+    send_task(
+        name=name,
+        message=message,
+        routing_key=message["organization_slug_name"],
+        **get_synchronous_message_options(),
+    )
+
+
+def synchronous_atomic(using=None):
+    """
+    The outbox rows must be written in the transaction of the change, which
+    would commit on its own in autocommit
+    """
+    if getattr(settings, "SYNCHRONOUS_MODEL_OUTBOX", False):
+        return transaction.atomic(using=using)
+    return contextlib.nullcontext()
+
+
+class SynchronousMessageBuffer:
+    """
+    Collects the replicated changes of the current transaction, keeping only
+    the last state of each row (a delete wins), and publishes them after the
+    commit as one update and one delete message per model and tenant.
+
+    Every schedule() registers an on_commit marker, which Django drops with
+    its savepoint, and a single flush is pending per transaction. The hooks
+    are only referenced by the connection, so a weak reference tells whether
+    a hook is still pending or was dropped.
+    """
+
+    def __init__(self):
+        self.changes = []
+        self.markers = {}
+        self.committed = set()
+        self.flush_hook = None
+        self.tokens = itertools.count()
+
+    def schedule(self, model_name, organization_slug_name, changes, partial=False):
+        """
+        Buffer the (pk, data) changes of the model, data being DELETED for a
+        delete
+        """
+        token = next(self.tokens)
+        marker = functools.partial(self.commit, token)
+        self.markers[token] = weakref.ref(marker)
+        transaction.on_commit(marker)
+        for pk, data in changes:
+            self.changes.append(
+                (token, model_name, organization_slug_name, pk, data, partial)
+            )
+
+        if self.flush_hook is None or self.flush_hook() is None:
+            flush = functools.partial(self.flush)
+            transaction.on_commit(flush)
+            self.flush_hook = weakref.ref(flush)
+
+    def commit(self, token):
+        if token in self.markers:
+            self.committed.add(token)
+
+    def collapse(self, changes, markers, committed):
+        """
+        Return the last state of each row changed outside of the rolled back
+        savepoints, their markers were dropped without running
+        """
+        rows = {}
+        for token, model_name, organization_slug_name, pk, data, partial in changes:
+            if token not in committed and markers[token]() is None:
+                continue
+
+            key = (model_name, organization_slug_name, pk)
+            change = rows.get(key)
+            if change is DELETED:
+                continue
+            if data is not DELETED and partial and change is not None:
+                # Merge the delta into the previous state of the row
+                previous_data, previous_partial = change
+                data, partial = {**previous_data, **data}, previous_partial
+            rows[key] = data if data is DELETED else (data, partial)
+        return rows
+
+    def flush(self):
+        changes, self.changes = self.changes, []
+        markers, self.markers = self.markers, {}
+        committed, self.committed = self.committed, set()
+
+        updates = defaultdict(list)
+        deletes = defaultdict(list)
+        latest = self.collapse(changes, markers, committed)
+        for (model_name, organization_slug_name, pk), change in latest.items():
+            if change is DELETED:
+                deletes[(model_name, organization_slug_name)].append(pk)
+            else:
+                data, partial = change
+                updates[(model_name, organization_slug_name, partial)].append(data)
+
+        for (model_name, organization_slug_name, partial), rows in updates.items():
+            message = {"organization_slug_name": organization_slug_name, "data": rows}
+            if partial:
+                message["partial"] = True
+            send_synchronous_message(name=f"update_{model_name}", message=message)
+        for (model_name, organization_slug_name), pks in deletes.items():
+            send_synchronous_message(
+                name=f"delete_{model_name}",
+                message={"organization_slug_name": organization_slug_name, "pk": pks},
+            )
+
+
+def is_coalescing_synchronous_messages():
+    """
+    Messages are coalesced per transaction with SYNCHRONOUS_MODEL_COALESCE.
+    Consumers must handle the batched messages first, and the outbox mode
+    takes precedence as its rows are written before the commit.
+    """
+    return (
+        getattr(settings, "SYNCHRONOUS_MODEL_COALESCE", False)
+        and not getattr(settings, "SYNCHRONOUS_MODEL_OUTBOX", False)
+        and connection.in_atomic_block
+    )
+
+
+def is_sending_synchronous_delta():
+    return getattr(settings, "SYNCHRONOUS_MODEL_DELTA", False)
+
+
+def get_synchronous_message_buffer():
+    if not hasattr(connection, "synchronous_message_buffer"):
+        connection.synchronous_message_buffer = SynchronousMessageBuffer()
+    return connection.synchronous_message_buffer
+
+
+def is_synchronous_model(model):
+    return get_synchronous_metadata(model).enabled
+
+
+def send_synchronous_update_rows(model, rows):
+    """
+    Send the rows of the model in a single update message
+    """
+    if not rows:
+        return
+
+    organization_slug_name = connection.get_tenant().slug_name
+    if is_coalescing_synchronous_messages():
+        get_synchronous_message_buffer().schedule(
+            model._meta.model_name,
+            organization_slug_name,
+            [(row[model._meta.pk.name], row) for row in rows],
+        )
+        return
+
+    send_synchronous_message(
+        name=f"update_{model._meta.model_name}",
+        message={"organization_slug_name": organization_slug_name, "data": rows},
+    )
+
+
+def send_synchronous_delete_pks(model, pks):
+    """
+    Send the deleted pks of the model in a single delete message
+    """
+    if not pks:
+        return
+
+    organization_slug_name = connection.get_tenant().slug_name
+    if is_coalescing_synchronous_messages():
+        get_synchronous_message_buffer().schedule(
+            model._meta.model_name,
+            organization_slug_name,
+            [(pk, DELETED) for pk in pks],
+        )
+        return
+
+    send_synchronous_message(
+        name=f"delete_{model._meta.model_name}",
+        message={"organization_slug_name": organization_slug_name, "pk": pks},
+    )
+
+
+def is_caching_user(model):
+    return model is get_user_model() and user_cache.enabled
+
+
+def invalidate_user_cache(model, pks):
+    """
+    The bulk writes do not send the signals that invalidate the cache of the
+    authenticated users, drop their entries once committed
+    """
+    if model is get_user_model():
+        user_cache.delete_on_commit(pks, using=router.db_for_write(model))
+
+
+def copy_loaded_value(value):
+    # The array and JSON values may be changed in place before the save
+    if isinstance(value, (list, dict, set)):
+        return copy.deepcopy(value)
+    return value
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        end = start + size
+        yield items[start:end]
+
+
+class SynchronousQuerySet(models.QuerySet):
+    """
+    Replicates the bulk operations with one message per chunk of
+    `batch_size` rows (SYNCHRONOUS_MODEL_BATCH_SIZE by default)
+    """
+
+    def get_synchronous_batch_size(self, batch_size=None):
+        return batch_size or getattr(settings, "SYNCHRONOUS_MODEL_BATCH_SIZE", 500)
+
+    def send_synchronous_instances(self, objs, batch_size=None):
+        for chunk in chunks(list(objs), self.get_synchronous_batch_size(batch_size)):
+            send_synchronous_update_rows(
+                self.model, [obj.get_synchronous_data() for obj in chunk]
+            )
+
+    def send_synchronous_pks(self, pks, batch_size=None):
+        batch_size = self.get_synchronous_batch_size(batch_size)
+        many_to_many = [
+            field.name for field in get_synchronous_metadata(self.model).many_to_many
+        ]
+        for chunk in chunks(pks, batch_size):
+            objs = self.model._base_manager.using(self.db).filter(pk__in=chunk)
+            if many_to_many:
+                objs = objs.prefetch_related(*many_to_many)
+            self.send_synchronous_instances(objs, batch_size)
+
+    def bulk_create(self, objs, batch_size=None, **kwargs):
+        if not is_synchronous_model(self.model):
+            objs = super().bulk_create(objs, batch_size=batch_size, **kwargs)
+        else:
+            with synchronous_atomic(using=self.db):
+                objs = super().bulk_create(objs, batch_size=batch_size, **kwargs)
+                if kwargs.get("ignore_conflicts") or kwargs.get("update_conflicts"):
+                    # The objects of the conflicting rows do not hold what is stored
+                    self.send_synchronous_pks(
+                        [obj.pk for obj in objs if obj.pk is not None], batch_size
+                    )
+                else:
+                    self.send_synchronous_instances(objs, batch_size)
+
+        if kwargs.get("update_conflicts") and is_caching_user(self.model):
+            # The upsert updates the existing users without the signals
+            invalidate_user_cache(
+                self.model, [obj.pk for obj in objs if obj.pk is not None]
+            )
+        return objs
+
+    # bulk_update() runs an update() per batch, which replicates the batch
+    def update(self, **kwargs):
+        synchronous = is_synchronous_model(self.model)
+        if not synchronous and not is_caching_user(self.model):
+            return super().update(**kwargs)
+
+        # QuerySet.update() skips auto_now, the consumers need the new version
+        # to order the updates of a row
+        version_field = get_synchronous_metadata(self.model).version_field
+        if (
+            synchronous
+            and getattr(version_field, "auto_now", False)
+            and version_field.name not in kwargs
+            and version_field.attname not in kwargs
+        ):
+            kwargs[version_field.name] = timezone.now()
+
+        with transaction.atomic(using=self.db):
+            pks = list(self.values_list("pk", flat=True))
+            # Only update the rows read, the rows inserted meanwhile would not
+            # be replicated
+            result = super(SynchronousQuerySet, self.filter(pk__in=pks)).update(
+                **kwargs
+            )
+            if synchronous:
+                # Read the rows back, the values may be expressions
+                self.send_synchronous_pks(pks)
+        invalidate_user_cache(self.model, pks)
+        return result
+
+    def delete(self):
+        if not is_synchronous_model(self.model):
+            return super().delete()
+
+        with transaction.atomic(using=self.db):
+            pks = list(self.values_list("pk", flat=True))
+            result = super().delete()
+            for chunk in chunks(pks, self.get_synchronous_batch_size()):
+                send_synchronous_delete_pks(self.model, chunk)
+        return result
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def send_synchronous_snapshot(self, batch_size=None):
+        """
+        Send every row of the tenant as snapshot messages, walking the primary
+        key in chunks of `batch_size` rows. Each message tells the consumers
+        the key range it covers, so they delete the rows of the range missing
+        from it. Yields the number of rows sent per chunk.
+        """
+        batch_size = self.get_synchronous_batch_size(batch_size)
+        metadata = get_synchronous_metadata(self.model)
+        objs = self.prefetch_related(*[field.name for field in metadata.many_to_many])
+        snapshot = {"started_at": time.time(), "after": None, "until": None}
+
+        for batch in iterate_keyset_batches(objs, batch_size=batch_size):
+            last = len(batch) < batch_size
+            snapshot["until"] = None if last else batch[-1].pk
+            self.send_synchronous_snapshot_message(batch, snapshot)
+            yield len(batch)
+
+            if last:
+                return
+            snapshot["after"] = snapshot["until"]
+
+        # The last batch was full or the tenant has no row
+        snapshot["until"] = None
+        self.send_synchronous_snapshot_message([], snapshot)
+        yield 0
+
+    def send_synchronous_snapshot_message(self, objs, snapshot):
+        send_synchronous_message(
+            name=f"update_{self.model._meta.model_name}",
+            message={
+                "organization_slug_name": connection.get_tenant().slug_name,
+                "data": [obj.get_synchronous_data() for obj in objs],
+                "snapshot": dict(snapshot),
+            },
+        )
+
+
+SynchronousManager = models.Manager.from_queryset(SynchronousQuerySet)
 
 
 class SynchronousTenantModel(models.Model):
@@ -10,56 +394,163 @@ class SynchronousTenantModel(models.Model):
     The abstract model is able to synchronous with another service via Celery
     """
 
-    pass
+    objects = SynchronousManager()
 
     class Meta:
         abstract = True
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Keep the loaded values to send only the changed fields on save
+        instance._synchronous_loaded_values = {
+            field_name: copy_loaded_value(value)
+            for field_name, value in zip(field_names, values)
+        }
+        return instance
+
+    def get_synchronous_db(self, using=None):
+        return using or router.db_for_write(self.__class__, instance=self)
+
     def save(self, *args, **kwargs):
-        result = super().save(*args, **kwargs)
+        if not is_synchronous_model(self):
+            return super().save(*args, **kwargs)
 
-        if (
-            hasattr(settings, "SYNCHRONOUS_MODEL")
-            and self._meta.model_name in settings.SYNCHRONOUS_MODEL
-        ):
-            self.send_synchronous_updating_message()
+        adding = self._state.adding
+        with synchronous_atomic(using=self.get_synchronous_db(kwargs.get("using"))):
+            result = super().save(*args, **kwargs)
+            if is_sending_synchronous_delta() and not adding:
+                self.send_synchronous_delta_message()
+            else:
+                self.send_synchronous_updating_message()
+        self.reset_synchronous_changes()
 
         return result
 
-    def send_synchronous_updating_message(self):
-        if hasattr(self, "synchronous_fields"):
-            synchronous_fields = self.synchronous_fields
-        else:
-            synchronous_fields = [field.name for field in self._meta.get_fields()]
-        send_task(
+    def get_synchronous_fields(self):
+        return get_synchronous_metadata(self).field_names
+
+    def reset_synchronous_changes(self):
+        deferred_fields = self.get_deferred_fields()
+        self._synchronous_loaded_values = {
+            field.attname: copy_loaded_value(getattr(self, field.attname))
+            for field in get_synchronous_metadata(self).concrete_fields
+            if field.attname not in deferred_fields
+        }
+        self._synchronous_changed_m2m = set()
+
+    def get_synchronous_delta(self):
+        """
+        Return the synchronous fields changed since the instance was loaded or
+        last saved, the many-to-many fields only when they were changed
+        through the instance. The id and updated_at are always included.
+        """
+        loaded_values = getattr(self, "_synchronous_loaded_values", {})
+        changed_m2m = getattr(self, "_synchronous_changed_m2m", set())
+        metadata = get_synchronous_metadata(self)
+
+        delta = {}
+        for field in metadata.concrete_fields:
+            if (
+                field.attname in loaded_values
+                and field.value_from_object(self) != loaded_values[field.attname]
+            ):
+                delta[field.name] = field.value_from_object(self)
+        for field in metadata.many_to_many:
+            if field.name in changed_m2m:
+                delta[field.name] = [i.id for i in field.value_from_object(self)]
+
+        if not delta:
+            return None
+
+        delta[metadata.pk_name] = self.pk
+        if metadata.has_updated_at:
+            delta["updated_at"] = self.updated_at
+        return delta
+
+    def send_synchronous_delta_message(self):
+        data = self.get_synchronous_delta()
+        if data is None:
+            return
+
+        organization_slug_name = connection.get_tenant().slug_name
+        if is_coalescing_synchronous_messages():
+            get_synchronous_message_buffer().schedule(
+                self._meta.model_name,
+                organization_slug_name,
+                [(self.pk, data)],
+                partial=True,
+            )
+            return
+
+        send_synchronous_message(
             name=f"update_{self._meta.model_name}",
             message={
-                "organization_slug_name": connection.get_tenant().slug_name,
-                "data": {
-                    key: value
-                    for (key, value) in model_to_dict(self).items()
-                    if key in synchronous_fields
-                },
+                "organization_slug_name": organization_slug_name,
+                "data": data,
+                "partial": True,
             },
         )
 
+    def get_synchronous_data(self):
+        return get_synchronous_metadata(self).serialize(self)
+
+    def send_synchronous_updating_message(self):
+        organization_slug_name = connection.get_tenant().slug_name
+        data = self.get_synchronous_data()
+
+        if is_coalescing_synchronous_messages():
+            get_synchronous_message_buffer().schedule(
+                self._meta.model_name, organization_slug_name, [(self.pk, data)]
+            )
+            return
+
+        send_synchronous_message(
+            name=f"update_{self._meta.model_name}",
+            message={"organization_slug_name": organization_slug_name, "data": data},
+        )
+
     def delete(self, *args, **kwargs):
-        pk = self.pk
-        result = super().delete(*args, **kwargs)
+        if not is_synchronous_model(self):
+            return super().delete(*args, **kwargs)
 
-        if (
-            hasattr(settings, "SYNCHRONOUS_MODEL")
-            and self._meta.model_name in settings.SYNCHRONOUS_MODEL
-        ):
+        pk = self.pk
+        with synchronous_atomic(using=self.get_synchronous_db(kwargs.get("using"))):
+            result = super().delete(*args, **kwargs)
             self.send_synchronous_delete_message(pk)
 
         return result
 
     def send_synchronous_delete_message(self, pk):
-        send_task(
+        organization_slug_name = connection.get_tenant().slug_name
+
+        if is_coalescing_synchronous_messages():
+            get_synchronous_message_buffer().schedule(
+                self._meta.model_name, organization_slug_name, [(pk, DELETED)]
+            )
+            return
+
+        send_synchronous_message(
             name=f"delete_{self._meta.model_name}",
-            message={
-                "organization_slug_name": connection.get_tenant().slug_name,
-                "pk": pk,
-            },
+            message={"organization_slug_name": organization_slug_name, "pk": pk},
         )
+
+
+@receiver(m2m_changed)
+def track_synchronous_m2m_changes(sender, instance, action, reverse, **kwargs):
+    """
+    Remember the many-to-many fields changed through a synchronous instance,
+    so the delta of its next save includes them
+    """
+    if (
+        reverse
+        or not isinstance(instance, SynchronousTenantModel)
+        or action not in ("post_add", "post_remove", "post_clear")
+    ):
+        return
+
+    for field in get_synchronous_metadata(instance).many_to_many:
+        if field.remote_field.through is sender:
+            if not hasattr(instance, "_synchronous_changed_m2m"):
+                instance._synchronous_changed_m2m = set()
+            instance._synchronous_changed_m2m.add(field.name)
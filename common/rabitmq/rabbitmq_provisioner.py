@@ -6,7 +6,8 @@ Handles vhost, user, queue, exchange, and binding provisioning for organizations
 
 import logging
 import time
-from typing import Dict, Optional, Set
+from collections import defaultdict
+from typing import Dict, List, Optional, Set
 from urllib.parse import quote, urlparse, urlunparse
 
 import requests
@@ -37,6 +38,7 @@ class RabbitMQProvisioner:
         self.session = requests.Session()
         self.session.auth = (self.admin_user, self.admin_password)
         self.session.headers.update({"Content-Type": "application/json"})
+        self.timeout = getattr(settings, "RABBITMQ_MANAGEMENT_API_TIMEOUT", 10)
 
     def _encode(self, value: str) -> str:
         """Percent-encode RabbitMQ resource identifiers for HTTP endpoints"""
@@ -82,31 +84,64 @@ class RabbitMQProvisioner:
         try:
             # Get queues in vhost
             encoded_vhost = self._encode(vhost_name)
-            response = self.session.get(f"{self.api_url}/api/queues/{encoded_vhost}")
+            response = self.session.get(
+                f"{self.api_url}/api/queues/{encoded_vhost}", timeout=self.timeout
+            )
             response.raise_for_status()
             queues = response.json()
 
             queue_count = len(queues)
-            message_count = sum(q.get("messages", 0) for q in queues)
+            message_count = sum(q.get("messages") or 0 for q in queues)
 
             # Get connections to vhost
-            response = self.session.get(f"{self.api_url}/api/vhosts/{encoded_vhost}")
+            response = self.session.get(
+                f"{self.api_url}/api/vhosts/{encoded_vhost}", timeout=self.timeout
+            )
             response.raise_for_status()
 
-            return {
-                "vhost": vhost_name,
-                "queue_count": queue_count,
-                "message_count": message_count,
-                "load_score": queue_count * 10 + message_count,  # Simple load metric
-            }
+            return self._build_vhost_load(vhost_name, queue_count, message_count)
         except requests.RequestException as e:
             logger.warning(f"Failed to get load for vhost {vhost_name}: {e}")
-            return {
-                "vhost": vhost_name,
-                "queue_count": 0,
-                "message_count": 0,
-                "load_score": 0,
-            }
+            return self._build_vhost_load(vhost_name, 0, 0)
+
+    def _build_vhost_load(
+        self, vhost_name: str, queue_count: int, message_count: int
+    ) -> Dict:
+        return {
+            "vhost": vhost_name,
+            "queue_count": queue_count,
+            "message_count": message_count,
+            "load_score": queue_count * 10 + message_count,  # Simple load metric
+        }
+
+    def get_vhost_loads(self, vhost_names: List[str]) -> List[Dict]:
+        """
+        Get load metrics for the vhosts from a single request listing only the
+        vhost and messages columns of every queue, falls back to one request
+        per vhost when it fails
+        """
+        try:
+            response = self.session.get(
+                f"{self.api_url}/api/queues",
+                params={"columns": "vhost,messages"},
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+            queues = response.json()
+        except requests.RequestException as e:
+            logger.warning(f"Failed to get the queues of all vhosts: {e}")
+            return [self.get_vhost_load(vhost) for vhost in vhost_names]
+
+        queue_counts = defaultdict(int)
+        message_counts = defaultdict(int)
+        for queue in queues:
+            queue_counts[queue.get("vhost")] += 1
+            message_counts[queue.get("vhost")] += queue.get("messages") or 0
+
+        return [
+            self._build_vhost_load(vhost, queue_counts[vhost], message_counts[vhost])
+            for vhost in vhost_names
+        ]
 
     def get_least_loaded_vhost(self) -> Optional[str]:
         """
@@ -117,7 +152,9 @@ class RabbitMQProvisioner:
         """
         try:
             # Get all vhosts
-            response = self.session.get(f"{self.api_url}/api/vhosts")
+            response = self.session.get(
+                f"{self.api_url}/api/vhosts", timeout=self.timeout
+            )
             response.raise_for_status()
             all_vhosts = response.json()
 
@@ -136,7 +173,7 @@ class RabbitMQProvisioner:
                 return None
 
             # Get load for each vhost
-            vhost_loads = [self.get_vhost_load(vhost) for vhost in tenant_vhosts]
+            vhost_loads = self.get_vhost_loads(tenant_vhosts)
 
             # Find least loaded vhost that's not overloaded
             least_loaded = min(vhost_loads, key=lambda x: x["load_score"])
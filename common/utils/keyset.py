@@ -0,0 +1,63 @@
+import contextlib
+
+from django.db.models import Q
+from django_tenants.utils import tenant_context
+
+
+def get_keyset_filter(keys, last_values):
+    """
+    Rows strictly after `last_values` in the order of `keys`, e.g. for
+    ("created_at", "id"): created_at > c OR (created_at = c AND id > i)
+    """
+    query = Q()
+    for index, key in enumerate(keys):
+        equal = {keys[previous]: last_values[previous] for previous in range(index)}
+        query |= Q(**equal, **{f"{key}__gt": last_values[index]})
+    return query
+
+
+def iterate_keyset_batches(
+    queryset, fields=(), batch_size=1000, keys=("pk",), tenant=None
+):
+    """
+    Walk the queryset in batches of `batch_size` rows ordered by `keys`,
+    each batch being a query on the next keys instead of an OFFSET, so the
+    memory and the cost of each query stay constant.
+
+    The batches are lists of `fields` tuples, or of instances honouring the
+    .only() and prefetch_related() of the queryset when no field is given.
+    With `tenant`, the queries run in its schema.
+    """
+    keys = tuple(keys)
+    last_values = None
+    while True:
+        batch_queryset = queryset.order_by(*keys)
+        if last_values is not None:
+            batch_queryset = batch_queryset.filter(get_keyset_filter(keys, last_values))
+        if fields:
+            batch_queryset = batch_queryset.values_list(*keys, *fields)
+
+        with tenant_context(tenant) if tenant else contextlib.nullcontext():
+            rows = list(batch_queryset[:batch_size])
+        if not rows:
+            return
+
+        if fields:
+            # The keys are selected first, and stripped from the yielded rows
+            width = len(keys)
+            last_values = rows[-1][:width]
+            rows = [row[width:] for row in rows]
+        else:
+            last_values = tuple(getattr(rows[-1], key) for key in keys)
+        yield rows
+
+        if len(rows) < batch_size:
+            return
+
+
+def iterate_keyset(queryset, fields=(), **kwargs):
+    """
+    Same as iterate_keyset_batches, one row at a time
+    """
+    for rows in iterate_keyset_batches(queryset, fields, **kwargs):
+        yield from rows
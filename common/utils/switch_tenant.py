@@ -1,10 +1,84 @@
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import connection
-from django_tenants.utils import get_tenant_domain_model
+from django_tenants.utils import get_public_schema_name, get_tenant_domain_model
 from rest_framework import status
 from rest_framework.exceptions import NotFound, ParseError
 from rest_framework.response import Response
 
+from common.utils.cache import LRUCache
+
+TENANT_NOT_FOUND = object()
+
+# Schema name -> tenant, invalidated by the signals in common.apps.organization
+schema_tenant_cache = LRUCache(
+    max_size=getattr(settings, "TENANT_CACHE_MAX_SIZE", 1024),
+    ttl=getattr(settings, "TENANT_CACHE_TTL", 300),
+)
+
+
+def is_schema_switch_coalesced():
+    return getattr(settings, "TENANT_COALESCE_SCHEMA_SWITCH", False)
+
+
+def set_connection_tenant(tenant):
+    """
+    Point the connection to the tenant schema.
+
+    In coalescing mode the switch is skipped when the connection is already
+    on the tenant schema, which keeps the `SET search_path` already issued
+    on it (django-tenants only sends it lazily, before the first query, and
+    only once per switch when TENANT_LIMIT_SET_CALLS is enabled).
+    """
+    if (
+        is_schema_switch_coalesced()
+        and connection.schema_name == tenant.schema_name
+        and getattr(connection, "include_public_schema", True)
+    ):
+        connection.tenant = tenant
+        return
+
+    connection.set_tenant(tenant)
+
+
+def set_connection_schema_to_public():
+    """
+    Point the connection to the public schema, see set_connection_tenant
+    """
+    if (
+        is_schema_switch_coalesced()
+        and connection.schema_name == get_public_schema_name()
+    ):
+        return
+
+    connection.set_schema_to_public()
+
+
+def get_tenant_from_schema_name(schema_name):
+    """
+    Return the tenant owning a domain with the given schema name, or None.
+    Hits the public schema only on a cache miss.
+    """
+    tenant = schema_tenant_cache.get(schema_name)
+    if tenant is not None:
+        return None if tenant is TENANT_NOT_FOUND else tenant
+
+    domain_model = get_tenant_domain_model()
+    try:
+        domain = domain_model.objects.select_related("tenant").get(
+            tenant__schema_name=schema_name
+        )
+    except ObjectDoesNotExist:
+        schema_tenant_cache.set(
+            schema_name,
+            TENANT_NOT_FOUND,
+            ttl=getattr(settings, "TENANT_CACHE_NOT_FOUND_TTL", 30),
+        )
+        return None
+
+    schema_tenant_cache.set(schema_name, domain.tenant)
+    return domain.tenant
+
 
 class UseTenantFromRequestMixin:
     def initial(self, request, *args, **kwargs):
@@ -21,14 +95,9 @@ class UseTenantFromRequestMixin:
         if not organization:
             raise ParseError("Missing 'organization' parameter")
 
-        domain_model = get_tenant_domain_model()
-        try:
-            domain = domain_model.objects.select_related("tenant").get(
-                tenant__schema_name=organization
-            )
-            tenant = domain.tenant
-        except ObjectDoesNotExist:
+        tenant = get_tenant_from_schema_name(organization)
+        if tenant is None:
             raise NotFound(f"Tenant '{organization}' not found")
 
-        connection.set_tenant(tenant)
+        set_connection_tenant(tenant)
         request.tenant = tenant